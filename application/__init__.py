@@ -1,19 +1,54 @@
+import time
+_import_started = time.perf_counter()
+
 from flask import Flask, request, session, redirect, url_for
 from flask_sqlalchemy import SQLAlchemy
-from os import path
 from flask_login import LoginManager, current_user
 
+# Flask, SQLAlchemy and flask-login load once per process, so only the first create_app reports it
+_import_time = time.perf_counter() - _import_started
+
 
 db = SQLAlchemy()
 DB_NAME = "database.sqlite3"
 
 
 def create_app():
+    global _import_time
+    from .profiling import StartupTimer
+    timer = StartupTimer()
+    if _import_time is not None:
+        timer.phases.append(('imports', _import_time))
+        _import_time = None
+
     app = Flask(__name__)
     app.config['SECRET_KEY'] = "JyHUS*(67679*^&3!$jiJS*Hs" 
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
+    app.config['PAGE_SIZE'] = 24
+    app.config['MAX_PAGE_SIZE'] = 100
+    app.config.from_prefixed_env()
+
+    from . import engine
+    engine.configure(app)
     db.init_app(app)
-    
+    engine.init_app(app)
+    timer.mark('config and engine')
+
+    from . import instrumentation, metrics, profiling
+    instrumentation.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+
+    from .cache import cache
+    cache.init_app(app)
+
+    from . import images
+    images.init_app(app)
+
+    from . import autocomplete
+    autocomplete.init_app(app)
+    timer.mark('extensions')
+
     from .views import views
     from .auth_user import auth_user
     from .auth_admin import auth_admin
@@ -22,35 +57,81 @@ def create_app():
     app.register_blueprint(views, url_prefix="/")
     app.register_blueprint(auth_user, url_prefix="/")
     app.register_blueprint(auth_admin, url_prefix="/admin")
-    
+
+    from .api import api
+    app.config.setdefault('API_MAX_AGE', 30)
+    app.register_blueprint(api, url_prefix="/api")
+    timer.mark('blueprints')
+
+    # Done by the first ORM query otherwise, so it shows up as its own phase instead of in whichever runs first
+    from sqlalchemy.orm import configure_mappers
+    configure_mappers()
+    timer.mark('ORM mappers')
+
+    app.config.setdefault('AUTO_MIGRATE', True)
     create_database(app)
+    timer.mark('schema check')
+
+    from .migrations import migrate_command
+    app.cli.add_command(migrate_command)
+
+    from .search import configure_search, facet_counts, rebuild_search_index_command
+    app.config.setdefault('SEARCH_CACHE_TTL', 120)
+    app.config.setdefault('FUZZY_CANDIDATES', 200)
+    app.config.setdefault('FUZZY_POSTINGS', 2000)
+    app.config.setdefault('FUZZY_MIN_SIMILARITY', 0.3)
+    configure_search(app)
+    app.add_template_global(facet_counts)
+    app.cli.add_command(rebuild_search_index_command)
+    timer.mark('search features')
+
+    images.resume_jobs(app)
+    timer.mark('image jobs')
+    app.cli.add_command(images.generate_image_variants_command)
+    app.cli.add_command(images.sweep_pictures_command)
+
+    from .catalog import import_catalog_command
+    app.cli.add_command(import_catalog_command)
+
+    from .benchmark import generate_catalog_command, benchmark_command
+    app.cli.add_command(generate_catalog_command)
+    app.cli.add_command(benchmark_command)
+
+    from .profiling import startup_report_command
+    app.cli.add_command(startup_report_command)
+    timer.mark('commands')
 
     login_manager = LoginManager(app)
     login_manager.blueprint_login_views = {'auth_user': 'auth_user.login', 'auth_admin': 'auth_admin.admin_login'}
     login_manager.init_app(app)
 
+    from .cache import init_identity_cache, load_identity
+    init_identity_cache(app)
+
     @login_manager.user_loader
     def load_user(id):
-        if session.get('user_type') == 'admin':
-            x = Admin.query.get(str(id))
-        elif session.get('user_type') == 'user':
-            x = User.query.get(str(id))
-        else:
-            x = None  
-        return x
-    
+        return load_identity(session.get('user_type'), id)
+    timer.mark('login')
+
+    from .profiling import report_startup
+    report_startup(app, timer)
     return app
 
 
+'''Create a new database, or bring an old one up to date. An up to date one costs a single PRAGMA read'''
 def create_database(app):
-    from .models import User, Admin, Cart, Product, Category, Unit
-    if not path.exists("application/" + DB_NAME):
-        with app.app_context():
-            db.create_all()
-            
-        print("Created database!")
-
-
-
+    from .migrations import LATEST_VERSION, migrate, schema_version
+    with app.app_context():
+        with db.engine.connect() as connection:
+            version = schema_version(connection)
+        if version == LATEST_VERSION:
+            # Every table already exists, so create_all's per-table introspection is skipped
+            return
 
+        from .models import User, Admin, Cart, Product, Category, Unit, ImageJob
+        db.create_all()
 
+    if app.config['AUTO_MIGRATE']:
+        migrate(app)
+    else:
+        app.logger.warning('Database schema is at version %d, latest is %d: run flask migrate.', version, LATEST_VERSION)
@@ -0,0 +1,216 @@
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import Blueprint, current_app, request, jsonify, abort, make_response, url_for
+from sqlalchemy import text
+from werkzeug.exceptions import HTTPException
+from . import db
+from .models import Product, Category, product_details
+from .search import search_categories, fuzzy_search_categories, find_products
+from .pagination import paginate
+from .cache import get_categories, get_category, category_snapshot
+from .images import picture_src
+from .autocomplete import suggest
+
+api = Blueprint("api", __name__)
+
+
+############################################################################################################################
+'''
+--------------------------------  CONDITIONAL GET  --------------------------------
+
+Every response is a function of the request URL and the catalog version, so the ETag is computed
+from those alone and a client holding the current ETag gets its 304 after a single primary key
+lookup. The version lives in the database (the catalog_version row, see migrations.py), bumped by
+triggers in the same transaction as every product, category and unit write, purchases included,
+so all workers agree on it and it survives restarts.
+'''
+############################################################################################################################
+
+
+'''Version and last write time (Unix seconds) of the catalog'''
+def catalog_version():
+    return db.session.execute(text('SELECT version, modified FROM catalog_version WHERE id = 1')).one()
+
+
+def catalog_etag(version):
+    return hashlib.sha1(('%d|%s' % (version, request.full_path)).encode('utf-8')).hexdigest()
+
+
+'''Serve a view's dict as JSON with an ETag and Last-Modified, answering 304 when the client is up to date'''
+def conditional(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, modified = catalog_version()
+        etag = catalog_etag(version)
+        last_modified = datetime.fromtimestamp(modified, timezone.utc)
+
+        if request.if_none_match.contains_weak(etag) or \
+                (not request.if_none_match and request.if_modified_since and last_modified <= request.if_modified_since):
+            response = make_response('', 304)
+        else:
+            response = jsonify(view(*args, **kwargs))
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['API_MAX_AGE']
+        return response
+    return wrapper
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    return jsonify(error=error.name, message=error.description), error.code
+
+
+############################################################################################################################
+'''
+--------------------------------  SERIALIZATION  --------------------------------
+'''
+############################################################################################################################
+
+
+PRODUCT_FIELDS = ('id', 'product_name', 'category_id', 'category_name', 'unit_name', 'rate_per_unit',
+                  'total_quantity', 'manufacture_date', 'picture')
+CATEGORY_FIELDS = ('id', 'category_name', 'picture')
+
+
+'''Fields asked for with ?fields=a,b (all of them by default), 400 for unknown ones'''
+def requested_fields(allowed):
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(400, 'Unknown fields: %s. Available: %s.' % (', '.join(unknown), ', '.join(allowed)))
+    return fields
+
+
+# Each field is computed only when it was asked for
+PRODUCT_VALUES = {
+    'id': lambda product: product.id,
+    'product_name': lambda product: product.product_name,
+    'category_id': lambda product: product.category_id,
+    'category_name': lambda product: product.category.category_name,
+    'unit_name': lambda product: product.unit.unit_name,
+    'rate_per_unit': lambda product: product.rate_per_unit,
+    'total_quantity': lambda product: product.total_quantity,
+    'manufacture_date': lambda product: product.manufacture_date.isoformat(),
+    'picture': lambda product: picture_src(product.product_picture, product.product_picture_variants, 'detail'),
+}
+
+CATEGORY_VALUES = {
+    'id': lambda category: category['id'],
+    'category_name': lambda category: category['category_name'],
+    'picture': lambda category: picture_src(category['category_picture'], category['category_picture_variants'], 'detail'),
+}
+
+
+def product_json(product, fields):
+    return {field: PRODUCT_VALUES[field](product) for field in fields}
+
+
+def category_json(category, fields):
+    return {field: CATEGORY_VALUES[field](category) for field in fields}
+
+
+def page_json(page, fields):
+    return {
+        'items': [product_json(product, fields) for product in page.items],
+        'next': page.next_url,
+        'prev': page.prev_url,
+    }
+
+
+'''Products matching the search filters in the query string (query, price, date_filter, category_id)'''
+def filtered_products():
+    date_filter = request.args.get('date_filter')
+    try:
+        date_filter = datetime.strptime(date_filter, '%Y-%m-%d').date() if date_filter else None
+        price = float(request.args['price']) if request.args.get('price') else None
+    except ValueError:
+        abort(400, 'price must be a number and date_filter a YYYY-MM-DD date.')
+
+    return find_products(Product.query.options(*product_details()), request.args.get('query'),
+                         price=price, date_filter=date_filter, category_id=request.args.get('category_id', type=int),
+                         fuzzy=request.args.get('fuzzy') == '1')
+
+
+############################################################################################################################
+'''
+--------------------------------  ENDPOINTS  --------------------------------
+'''
+############################################################################################################################
+
+
+# Products, optionally filtered like the search page
+@api.route("/products")
+@conditional
+def products():
+    fields = requested_fields(PRODUCT_FIELDS)
+    products, sort_keys = filtered_products()
+    return page_json(paginate(products, sort_keys), fields)
+
+
+@api.route("/products/<int:product_id>")
+@conditional
+def product(product_id):
+    fields = requested_fields(PRODUCT_FIELDS)
+    product = Product.query.options(*product_details()).filter_by(id=product_id).first()
+    if product is None:
+        abort(404)
+    return product_json(product, fields)
+
+
+@api.route("/categories")
+@conditional
+def categories():
+    fields = requested_fields(CATEGORY_FIELDS)
+    return {'items': [category_json(category, fields) for category in get_categories()]}
+
+
+@api.route("/categories/<int:category_id>")
+@conditional
+def category(category_id):
+    fields = requested_fields(CATEGORY_FIELDS)
+    category = get_category(category_id)
+    if category is None:
+        abort(404)
+    return category_json(category, fields)
+
+
+# Search page as JSON: matching categories plus a page of matching products
+@api.route("/search")
+@conditional
+def search():
+    query = request.args.get('query')
+    fields = requested_fields(PRODUCT_FIELDS)
+    products, sort_keys = filtered_products()
+
+    search = fuzzy_search_categories if request.args.get('fuzzy') == '1' else search_categories
+    categories = search(Category.query, query).limit(current_app.config['MAX_PAGE_SIZE']).all() if query else []
+
+    return dict(page_json(paginate(products, sort_keys), fields),
+                categories=[category_json(category_snapshot(category), CATEGORY_FIELDS) for category in categories])
+
+
+# Typeahead suggestions for ?q=, served from the in-memory prefix index without touching the database.
+# Not conditional: the index can lag the catalog version, so a short max-age stands in for validators.
+@api.route("/suggest")
+def suggestions():
+    limit = request.args.get('limit', type=int) or current_app.config['AUTOCOMPLETE_LIMIT']
+    limit = max(1, min(limit, current_app.config['AUTOCOMPLETE_MAX_LIMIT']))
+
+    views = {'product': ('views.view_product', 'product_id'), 'category': ('views.view_category', 'category_id')}
+    items = []
+    for kind, id, name in suggest(request.args.get('q', ''), limit):
+        endpoint, argument = views[kind]
+        items.append({'type': kind, 'id': id, 'name': name, 'url': url_for(endpoint, **{argument: id})})
+
+    response = jsonify(items=items)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['AUTOCOMPLETE_HTTP_MAX_AGE']
+    return response
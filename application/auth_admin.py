@@ -1,14 +1,18 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, session
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session, abort, Response, stream_with_context, send_from_directory
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
 from datetime import datetime
-import secrets
-import os
-from PIL import Image
+from functools import wraps
 from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 from . import db
-from .models import Admin, Category, Product, Unit
+from .models import Admin, Category, Product, Unit, ImageJob, product_details
+from .pagination import paginate
+from .cache import catalog_changed, get_categories, get_units, forget_identity
+from .images import queue_picture, discard_picture, retry_job, PLACEHOLDER_PICTURE
+from .catalog import export_rows, delete_category_cascade, EXPORT_FORMATS
+from .metrics import BCRYPT_TIME, CONTENT_TYPE, render_metrics, scraper_authorized
+from .profiling import list_profiles, profiles_dir, PROFILE_NAME
 
 
 auth_admin = Blueprint('auth_admin', __name__)
@@ -17,19 +21,19 @@ bcrypt = Bcrypt()
 
 ############################################################################################################################
 
-'''Save picture to static/images folder and return the filename'''
-def save_picture(form_picture, pic_filename):
-    random_hex = secrets.token_hex(16)
-    _, f_ext = os.path.splitext(pic_filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(auth_admin.root_path, 'static/images', picture_fn)
+'''login_required that also turns away logged in users who are not admins'''
+def admin_required(view):
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not current_user.is_admin():
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
 
-    output_size = (350, 350)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
+'''Store the uploaded picture and queue its thumbnail, the owner shows a placeholder until the job is done'''
+def save_picture(form_picture, pic_filename, owner):
+    return queue_picture(form_picture, pic_filename, owner)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'svg'}
 
@@ -37,16 +41,9 @@ def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+'''Remove a picture once the change that stops using it commits, if no other product or category shares it'''
 def delete_picture(pic_filename):
-    pic_path = os.path.join(auth_admin.root_path, 'static/images', pic_filename)
-
-    try:
-        os.remove(pic_path)
-        print("% s removed successfully" % pic_path)
-    except OSError as error:
-        print(error)
-        print("File path can not be removed")
-        flash('Error occured while deleting image.', category='error')
+    discard_picture(pic_filename)
 
 ############################################################################################################################
 
@@ -60,7 +57,10 @@ def admin_login():
         admin = Admin.query.filter_by(admin_name=admin_name).first()
 
         if admin:
-            if bcrypt.check_password_hash(admin.password_hash, password):
+            with BCRYPT_TIME.time(operation='check'):
+                password_ok = bcrypt.check_password_hash(admin.password_hash, password)
+
+            if password_ok:
                 flash('Logged in successfully!', category='success')
                 login_user(admin, remember=True)
                 session['user_type'] = 'admin'
@@ -75,6 +75,7 @@ def admin_login():
 @auth_admin.route('/admin_logout')
 @login_required
 def admin_logout():
+    forget_identity(session.get('user_type'), current_user.id)
     session.pop('user_type', None)
     logout_user()
     return redirect(url_for('views.home'))
@@ -86,6 +87,14 @@ def admin_view():
     return render_template("admin/admin_view.html", user=current_user)
 
 
+# Prometheus metrics, for a logged in admin or a scraper sending METRICS_TOKEN as a bearer token
+@auth_admin.route('/metrics')
+def metrics():
+    if not scraper_authorized() and not (current_user.is_authenticated and current_user.is_admin()):
+        abort(403)
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
 
 ############################################################################################################################
 '''
@@ -98,24 +107,48 @@ def admin_view():
 @auth_admin.route('/category_list')
 @login_required
 def category_list():
-    categories = Category.query.all()
-    return render_template('admin/category_pages/category_list.html', categories=categories, user=current_user)
+    page = paginate(Category.query, [Category.id])
+    return render_template('admin/category_pages/category_list.html', categories=page.items, page=page, user=current_user)
 
 
 # Product list
 @auth_admin.route('/product_list')
 @login_required
 def product_list():
-    products = Product.query.all()
-    return render_template('admin/product_pages/product_list.html', products=products, user=current_user)
+    page = paginate(Product.query.options(*product_details()), [Product.id])
+    return render_template('admin/product_pages/product_list.html', products=page.items, page=page, user=current_user)
 
 
 # Unit list
 @auth_admin.route('/unit_list')
 @login_required
 def unit_list():
-    units = Unit.query.all()
-    return render_template('admin/unit_pages/unit_list.html', units=units, user=current_user)
+    page = paginate(Unit.query, [Unit.id])
+    return render_template('admin/unit_pages/unit_list.html', units=page.items, page=page, user=current_user)
+
+
+
+# Product export, streamed as CSV or NDJSON with the search page's filters
+@auth_admin.route('/export_products')
+@admin_required
+def export_products():
+    file_format = request.args.get('format', 'csv')
+    if file_format not in EXPORT_FORMATS:
+        abort(400)
+
+    date_filter = request.args.get('date_filter')
+    try:
+        date_filter = datetime.strptime(date_filter, '%Y-%m-%d').date() if date_filter else None
+        price = float(request.args['price']) if request.args.get('price') else None
+    except ValueError:
+        abort(400)
+
+    rows = export_rows(request.args.get('query'), price, date_filter, request.args.get('category_id', type=int))
+    generate, mimetype = EXPORT_FORMATS[file_format]
+    filename = 'products-%s.%s' % (datetime.now().strftime('%Y%m%d-%H%M%S'), file_format)
+
+    return Response(stream_with_context(generate(rows)), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
 
 
 
@@ -170,12 +203,14 @@ def new_category():
             try:
                 db.session.begin_nested()
 
-                new_category = Category(category_name=category_name)
-                new_pic_filename = save_picture(category_picture, pic_filename)
+                new_category = Category(category_name=category_name, category_picture=PLACEHOLDER_PICTURE)
+                db.session.add(new_category)
+
+                new_pic_filename = save_picture(category_picture, pic_filename, new_category)
                 new_category.category_picture = new_pic_filename
 
-                db.session.add(new_category)
                 db.session.commit()
+                catalog_changed('categories')
 
                 flash('Category created!', category='success')
                 new_cat = Category.query.filter_by(category_name=category_name).first()
@@ -233,10 +268,11 @@ def edit_category(category_id):
                     delete_picture(old_pic_filename)
                     
                     # Save new picture
-                    new_pic_filename = save_picture(new_image, pic_filename)
+                    new_pic_filename = save_picture(new_image, pic_filename, category)
                     category.category_picture = new_pic_filename
 
                     db.session.commit()
+                    catalog_changed('categories')
 
                     flash('Category image updated!', category='success')
                     flash('Check category name.', category='error')
@@ -267,10 +303,11 @@ def edit_category(category_id):
                     delete_picture(old_pic_filename)
                     
                     # Save new picture
-                    new_pic_filename = save_picture(new_image, pic_filename)
+                    new_pic_filename = save_picture(new_image, pic_filename, category)
                     category.category_picture = new_pic_filename
                     
                     db.session.commit()
+                    catalog_changed('categories')
 
                     flash('Category updated!', category='success')
                     return redirect(url_for('auth_admin.view_category', category_id=category_id))
@@ -291,6 +328,7 @@ def edit_category(category_id):
                     category.category_name = new_name
                     
                     db.session.commit()
+                    catalog_changed('categories')
 
                     flash('Category updated!', category='success')
                     return redirect(url_for('auth_admin.view_category', category_id=category_id))
@@ -319,38 +357,16 @@ def delete_category(category_id):
     if request.method == 'POST':
         try:
             db.session.begin_nested()
+            category_name = category.category_name
 
-            # Find all products in that category and delete them
-            products = Product.query.filter_by(category_id=category_id).all()
-            
-            if products:
-                for product in products:
-                    # Delete product picture
-                    prod_pic_filename = product.product_picture
-                    delete_picture(prod_pic_filename)
-
-                    db.session.delete(product)
+            # Products, their cart lines and the category in one transaction, pictures are removed after it commits
+            deleted = delete_category_cascade(category)
+            db.session.commit()
+            catalog_changed('categories')
 
-                # Delete category picture
-                pic_filename = category.category_picture
-                delete_picture(pic_filename)
-                
-                db.session.delete(category)
-                db.session.commit()
+            flash(f'Category "{category_name}" and its {deleted} products have been deleted.', 'success')
+            return redirect(url_for('auth_admin.category_list'))
 
-                flash(f'Category "{category.category_name}" has been deleted.', 'success')
-                return redirect(url_for('auth_admin.category_list'))
-            
-            else:
-                # Delete category picture
-                pic_filename = category.category_picture
-                delete_picture(pic_filename)
-                
-                db.session.delete(category)
-                db.session.commit()
-                flash(f'Category "{category.category_name}" has been deleted.', 'success')
-                return redirect(url_for('auth_admin.category_list'))
-        
         except IntegrityError:
             db.session.rollback()
             flash('Something went wrong.', category='error')
@@ -480,12 +496,14 @@ def new_product():
             try:
                 db.session.begin_nested()
 
-                new_product = Product(product_name=product_name, total_quantity=total_quantity, rate_per_unit=rate_per_unit, manufacture_date=manufacture_date, unit_id=unit_id, category_id=category_id)
-                new_pic_filename = save_picture(product_picture, pic_filename)
+                new_product = Product(product_name=product_name, product_picture=PLACEHOLDER_PICTURE, total_quantity=total_quantity, rate_per_unit=rate_per_unit, manufacture_date=manufacture_date, unit_id=unit_id, category_id=category_id)
+                db.session.add(new_product)
+
+                new_pic_filename = save_picture(product_picture, pic_filename, new_product)
                 new_product.product_picture = new_pic_filename
 
-                db.session.add(new_product)
                 db.session.commit()
+                catalog_changed()
 
                 flash('Product created!', category='success')
                 new_prod = Product.query.filter_by(product_name=product_name).first()
@@ -504,15 +522,15 @@ def new_product():
             flash('Something went wrong.', category='error')
             return redirect(url_for('auth_admin.new_product'))
         
-    units = Unit.query.all()
-    categories = Category.query.all()
+    units = get_units()
+    categories = get_categories()
     return render_template('admin/product_pages/new_product.html', user=current_user, categories=categories, units=units)
     
 # Read product
 @auth_admin.route('/view_product/<int:product_id>')
 @login_required
 def view_product(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = Product.query.options(*product_details()).get_or_404(product_id)
     return render_template('admin/product_pages/view_product.html', user=current_user, product=product, product_id=product_id)
 
 # Update product
@@ -581,10 +599,11 @@ def edit_product(product_id):
 
                     # Delete old picture and save new picture
                     delete_picture(old_pic_filename)
-                    new_pic_filename = save_picture(new_image, pic_filename)
+                    new_pic_filename = save_picture(new_image, pic_filename, product)
                     product.product_picture = new_pic_filename
 
                     db.session.commit()
+                    catalog_changed()
 
                     flash('Product image updated!', category='success')
                     return redirect(url_for('auth_admin.view_product', product_id=product_id))
@@ -603,7 +622,7 @@ def edit_product(product_id):
                     
                     # Delete old picture and save new picture
                     delete_picture(old_pic_filename)
-                    new_pic_filename = save_picture(new_image, pic_filename)
+                    new_pic_filename = save_picture(new_image, pic_filename, product)
                     product.product_picture = new_pic_filename
                     
                     # Update other data
@@ -615,6 +634,7 @@ def edit_product(product_id):
                     product.category_id = new_category_id
                     
                     db.session.commit()
+                    catalog_changed()
 
                     flash('Product updated!', category='success')
                     return redirect(url_for('auth_admin.view_product', product_id=product_id))
@@ -650,6 +670,7 @@ def edit_product(product_id):
                 product.category_id = new_category_id
                 
                 db.session.commit()
+                catalog_changed()
 
                 flash('Product updated!', category='success')
                 return redirect(url_for('auth_admin.view_product', product_id=product_id))
@@ -663,8 +684,8 @@ def edit_product(product_id):
                 db.session.close()
     
 
-    units = Unit.query.all()
-    categories = Category.query.all()
+    units = get_units()
+    categories = get_categories()
     return render_template('admin/product_pages/edit_product.html', product=product, user=current_user, product_id=product_id, units=units, categories=categories)
 
 # Delete product
@@ -682,6 +703,7 @@ def delete_product(product_id):
             
             db.session.delete(product)
             db.session.commit()
+            catalog_changed()
 
             flash(f'Product "{product.product_name}" has been deleted.', 'success')
             return redirect(url_for('auth_admin.product_list'))
@@ -727,6 +749,7 @@ def new_unit():
 
                 db.session.add(new_unit)
                 db.session.commit()
+                catalog_changed('units')
 
                 flash('Unit created!', category='success')
                 return render_template('admin/unit_pages/new_unit.html', user=current_user)
@@ -778,6 +801,7 @@ def edit_unit(unit_id):
 
                 unit.unit_name = new_name
                 db.session.commit()
+                catalog_changed('units')
 
                 flash('Unit updated!', category='success')
                 return redirect(url_for('auth_admin.view_unit', unit_id=unit_id))
@@ -804,6 +828,7 @@ def delete_unit(unit_id):
 
             db.session.delete(unit)
             db.session.commit()
+            catalog_changed('units')
 
             flash(f'Unit "{unit.unit_name}" has been deleted.', 'success')
             return redirect(url_for('auth_admin.unit_list'))
@@ -818,3 +843,57 @@ def delete_unit(unit_id):
     
     return render_template('admin/unit_pages/delete_unit.html', unit=unit, user=current_user, unit_id=unit_id)
 
+
+
+############################################################################################################################
+'''
+--------------------------------  IMAGE JOBS  --------------------------------
+'''
+############################################################################################################################
+
+
+# Thumbnail jobs that are pending, processing or failed
+@auth_admin.route('/image_jobs')
+@admin_required
+def image_jobs():
+    page = paginate(ImageJob.query.filter(ImageJob.status != 'done'), [ImageJob.id])
+    return render_template('admin/image_jobs.html', jobs=page.items, page=page, user=current_user)
+
+# Retry a failed job
+@auth_admin.route('/retry_image_job/<int:job_id>', methods=['POST'])
+@admin_required
+def retry_image_job(job_id):
+    job = ImageJob.query.get_or_404(job_id)
+
+    if job.status != 'failed':
+        flash('Only failed jobs can be retried.', category='error')
+        return redirect(url_for('auth_admin.image_jobs'))
+
+    retry_job(job)
+    db.session.commit()
+
+    flash('Image job queued again.', category='success')
+    return redirect(url_for('auth_admin.image_jobs'))
+
+
+
+############################################################################################################################
+'''
+--------------------------------  PROFILES  --------------------------------
+'''
+############################################################################################################################
+
+
+# Saved request profiles (add ?profile=1 to any page to make one)
+@auth_admin.route('/profiles')
+@admin_required
+def profiles():
+    return render_template('admin/profiles.html', profiles=list_profiles(), user=current_user)
+
+# Download a profile as a .pstats file
+@auth_admin.route('/profiles/<name>')
+@admin_required
+def download_profile(name):
+    if not PROFILE_NAME.fullmatch(name):
+        abort(404)
+    return send_from_directory(profiles_dir(), name, as_attachment=True)
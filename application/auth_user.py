@@ -2,7 +2,12 @@ from flask import Blueprint, render_template, redirect, url_for, request, flash,
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
 from . import db
-from .models import User, Admin, Cart, Product, Category, Unit
+from .models import User, Admin, Cart, Product, Category, Unit, cart_details
+from .checkout import checkout, buy_product, load_cart, cart_total, CART_CHANGED
+from .carts import save_line, set_quantity
+from .cache import forget_identity
+from .engine import retry_on_lock
+from .metrics import BCRYPT_TIME
 from sqlalchemy.exc import IntegrityError
 
 
@@ -18,7 +23,10 @@ def login():
 
         user = User.query.filter_by(username=username).first()
 
-        if user and bcrypt.check_password_hash(user.password_hash, password):
+        with BCRYPT_TIME.time(operation='check'):
+            password_ok = user is not None and bcrypt.check_password_hash(user.password_hash, password)
+
+        if password_ok:
                 flash('Logged in successfully!', category='success')
                 login_user(user, remember=True)
                 session['user_type'] = 'user'
@@ -51,7 +59,9 @@ def signup():
         elif len(password1) < 8:
             flash('Password must be at least 8 characters.', category='error')
         else:
-            new_user = User(username=username, password_hash=bcrypt.generate_password_hash(password1).decode('utf-8'))
+            with BCRYPT_TIME.time(operation='hash'):
+                password_hash = bcrypt.generate_password_hash(password1).decode('utf-8')
+            new_user = User(username=username, password_hash=password_hash)
             db.session.add(new_user)
             db.session.commit()
             login_user(new_user, remember=True)
@@ -65,6 +75,7 @@ def signup():
 @auth_user.route('/logout')
 @login_required
 def logout():
+    forget_identity(session.get('user_type'), current_user.id)
     session.pop('user_type', None)
     logout_user()
     return redirect(url_for('views.home'))
@@ -81,6 +92,7 @@ def logout():
 # CREATE CART
 @auth_user.route('/add_to_cart/<int:product_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_lock
 def add_to_cart(product_id):
     if request.method == 'POST':
         quantity = request.form.get('quantity')
@@ -91,16 +103,14 @@ def add_to_cart(product_id):
             flash('Invalid input', category='error')
             return redirect(url_for('views.home'))
 
-        cart = Cart.query.filter_by(prod_id=product_id, user_id=current_user.id).first()
+        if quantity <= 0:
+            flash('Invalid quantity', category='error')
+            return redirect(url_for('auth_user.add_to_cart', product_id=product_id))
 
         try:
             db.session.begin_nested()
 
-            if cart:
-                cart.product_quantity += quantity
-            else:
-                cart = Cart(prod_id=product_id, product_quantity=quantity, user_id=current_user.id)
-                db.session.add(cart)
+            save_line(current_user.id, product_id, quantity)
 
             db.session.commit()
 
@@ -119,13 +129,14 @@ def add_to_cart(product_id):
 @auth_user.route('/cart')
 @login_required
 def cart():
-    carts = Cart.query.filter_by(user_id=int(current_user.id)).all()
+    carts = Cart.query.options(*cart_details()).filter_by(user_id=int(current_user.id)).all()
     return render_template('cart.html', user=current_user, carts=carts)
 
 
 # UPDATE CART
 @auth_user.route('/update_cart/<int:cart_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_lock
 def update_cart(cart_id):
     if request.method == 'POST':
         quantity = request.form.get('quantity')
@@ -136,16 +147,17 @@ def update_cart(cart_id):
             flash('Invalid input', category='error')
             return redirect(url_for('views.home'))
 
-        cart = Cart.query.filter_by(id=cart_id, user_id=current_user.id).first()
-        if not cart:
-            flash('Product not found', category='error')
-            return redirect(url_for('views.cart'))
-
+        if quantity <= 0:
+            flash('Invalid quantity', category='error')
+            return redirect(url_for('auth_user.update_cart', cart_id=cart_id))
 
         try:
             db.session.begin_nested()
 
-            cart.product_quantity = quantity
+            if not set_quantity(current_user.id, cart_id, quantity):
+                db.session.rollback()
+                flash('Product not found', category='error')
+                return redirect(url_for('auth_user.cart'))
 
             db.session.commit()
 
@@ -163,6 +175,7 @@ def update_cart(cart_id):
 # DELETE CART
 @auth_user.route('/remove_from_cart/<int:cart_id>')
 @login_required
+@retry_on_lock
 def remove_from_cart(cart_id):
     try:
         cart_id = int(cart_id)
@@ -193,6 +206,7 @@ def remove_from_cart(cart_id):
 # DELETE ALL CART
 @auth_user.route('/remove_all_from_cart')
 @login_required
+@retry_on_lock
 def remove_all_from_cart():
     carts = Cart.query.filter_by(user_id=current_user.id).all()
     if not carts:
@@ -226,88 +240,81 @@ def remove_all_from_cart():
 ##############################################################################################################
 
 
+'''Flash one error for every cart line that could not be bought'''
+def flash_failures(failures):
+    for failure in failures:
+        if failure is CART_CHANGED:
+            flash('Your cart changed, please try again.', category='error')
+        elif failure.requested <= 0:
+            flash(f'Invalid quantity for "{failure.product_name}".', category='error')
+        else:
+            flash(f'Only {failure.available} of "{failure.product_name}" left in stock, you asked for {failure.requested}.', category='error')
+
+
 # CART PRODUCT PURCHASE
 @auth_user.route('/purchase/<int:cart_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_lock
 def purchase_cart(cart_id):
     if request.method == 'POST':
         try:
-            cart_id = int(cart_id)
-        except ValueError:
-            flash('Invalid input', category='error')
+            result = checkout(current_user.id, cart_ids=[cart_id])
+        
+        except IntegrityError:
+            flash('Error purchasing product', category='error')
             return redirect(url_for('views.home'))
 
-        cart = Cart.query.filter_by(id=cart_id, user_id=current_user.id).first()
-        if not cart:
+        if not result.lines:
             flash('Product not found', category='error')
-            return redirect(url_for('views.cart'))
-
-        try:
-            db.session.begin_nested()
-
-            product = Product.query.get(cart.prod_id)
-            product.total_quantity -= cart.product_quantity
-
-            db.session.delete(cart)
-            db.session.commit()
+            return redirect(url_for('auth_user.cart'))
 
-            flash('Purchase successful!', category='success')
+        if result.failures:
+            flash_failures(result.failures)
             return redirect(url_for('auth_user.cart'))
-        
-        except IntegrityError:
-            db.session.rollback()
-            flash('Error purchasing product', category='error')
-            return redirect(url_for('views.home'))
 
-    return render_template('purchase_cart.html', user=current_user, cart=Cart.query.get(cart_id))
+        flash('Purchase successful!', category='success')
+        return redirect(url_for('auth_user.cart'))
+
+    carts = load_cart(current_user.id, cart_ids=[cart_id])
+    return render_template('purchase_cart.html', user=current_user, cart=carts[0] if carts else None)
 
 
 # CART PURCHASE
 @auth_user.route('/purchase_all', methods=['GET', 'POST'])
 @login_required
+@retry_on_lock
 def purchase_all():
     if request.method == 'POST':
-        carts = Cart.query.filter_by(user_id=current_user.id).all()
-        if not carts:
-            flash('Cart is empty', category='error')
-            return redirect(url_for('views.cart'))
-
-        
-
         try:
-            db.session.begin_nested()
-
-            for cart in carts:
-                product = Product.query.get(cart.prod_id)
-                product.total_quantity -= cart.product_quantity
-
-                db.session.delete(cart)
-
-            db.session.commit()
-
-            flash('Purchase successful!', category='success')
-            return redirect(url_for('views.home'))
+            result = checkout(current_user.id)
         
         except IntegrityError:
-            db.session.rollback()
             flash('Error purchasing products', category='error')
             return redirect(url_for('views.home'))
 
-    carts = Cart.query.filter_by(user_id=current_user.id).all()
+        if not result.lines:
+            flash('Cart is empty', category='error')
+            return redirect(url_for('auth_user.cart'))
+
+        if result.failures:
+            flash_failures(result.failures)
+            return redirect(url_for('auth_user.cart'))
+
+        flash('Purchase successful!', category='success')
+        return redirect(url_for('views.home'))
+
+    carts = load_cart(current_user.id)
     if not carts:
         flash('Cart is empty', category='error')
-        return redirect(url_for('views.cart'))
+        return redirect(url_for('auth_user.cart'))
 
-    total_bill = 0
-    for cart in carts:
-        total_bill += cart.product_quantity * Product.query.get(cart.prod_id).rate_per_unit
-    
-    return render_template('purchase_all.html', user=current_user, carts=carts, total_bill=total_bill)
+    return render_template('purchase_all.html', user=current_user, carts=carts, total_bill=cart_total(carts))
 
 
 # DIRECT PRODUCT PURCHASE
 @auth_user.route('/purchase_product/<int:product_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_lock
 def purchase_product(product_id):
     if request.method == 'POST':
         quantity = request.form.get('quantity')
@@ -324,21 +331,17 @@ def purchase_product(product_id):
             return redirect(url_for('views.home'))
 
         try:
-            db.session.begin_nested()
-
-            product.total_quantity -= quantity
-
-            db.session.commit()
-
-            flash('Purchase successful!', category='success')
-            return redirect(url_for('auth_user.cart'))
+            result = buy_product(product, quantity)
         
         except IntegrityError:
-            db.session.rollback()
             flash('Error purchasing product', category='error')
             return redirect(url_for('views.home'))
 
-    return render_template('purchase_product.html', user=current_user, product=Product.query.get(product_id))
-
+        if result.failures:
+            flash_failures(result.failures)
+            return redirect(url_for('auth_user.purchase_product', product_id=product_id))
 
+        flash('Purchase successful!', category='success')
+        return redirect(url_for('auth_user.cart'))
 
+    return render_template('purchase_product.html', user=current_user, product=Product.query.get(product_id))
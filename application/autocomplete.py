@@ -0,0 +1,214 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import object_session
+from . import db
+from .models import Product, Category
+
+
+############################################################################################################################
+'''
+--------------------------------  AUTOCOMPLETE INDEX  --------------------------------
+
+Typeahead suggestions come from a sorted in-memory array instead of the database. Every name is
+indexed once per word, under its lowercase text from that word on ("Tomato Ketchup 1kg" under
+"tomato ketchup 1kg", "ketchup 1kg" and "1kg"), so "ket" and "tomato ke" both find it with one
+binary search followed by a short forward scan.
+
+The index is built on the first lookup of each worker. Product and category inserts, renames and
+deletes made through the ORM update it as soon as they commit. Writes by other workers (or by
+CLI imports) are picked up by a rebuild in a background thread once the index is older than
+AUTOCOMPLETE_MAX_AGE seconds, while the old index keeps answering.
+'''
+############################################################################################################################
+
+
+# Sort order of the kinds among otherwise equal suggestions
+KINDS = ('category', 'product')
+
+_WORD_STARTS = re.compile(r'\w+')
+
+
+'''Lowercase text of a name from each of its words on'''
+def index_keys(name):
+    text = ' '.join(name.lower().split())
+    return [text[match.start():] for match in _WORD_STARTS.finditer(text)]
+
+
+'''Typed text in the form of the index keys'''
+def normalize_prefix(prefix):
+    return ' '.join(prefix.lower().split())
+
+
+class PrefixIndex:
+    '''Sorted (key, kind, id) entries plus the name of each (kind, id), guarded by one lock.'''
+
+    def __init__(self, names=()):
+        self.names = {}
+        entries = []
+        for kind, id, name in names:
+            self.names[kind, id] = name
+            entries.extend((key, kind, id) for key in index_keys(name))
+        entries.sort()
+        self.entries = entries
+        self.built = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def put(self, kind, id, name):
+        with self._lock:
+            if self.names.get((kind, id)) == name:
+                return
+            self._remove(kind, id)
+            self.names[kind, id] = name
+            for key in index_keys(name):
+                entry = (key, kind, id)
+                self.entries.insert(bisect_left(self.entries, entry), entry)
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove(kind, id)
+
+    def _remove(self, kind, id):
+        name = self.names.pop((kind, id), None)
+        if name is None:
+            return
+        for key in index_keys(name):
+            index = bisect_left(self.entries, (key, kind, id))
+            if index < len(self.entries) and self.entries[index] == (key, kind, id):
+                del self.entries[index]
+
+    '''
+    Up to limit (kind, id, name) suggestions for a typed prefix. At most candidates entries are
+    scanned, then names starting with the prefix rank first, shorter names before longer ones.
+    '''
+    def lookup(self, prefix, limit=8, candidates=200):
+        prefix = normalize_prefix(prefix)
+        if not prefix:
+            return []
+
+        found = {}
+        with self._lock:
+            index = bisect_left(self.entries, (prefix,))
+            for key, kind, id in self.entries[index:index + candidates]:
+                if not key.startswith(prefix):
+                    break
+                found[kind, id] = self.names[kind, id]
+
+        ranked = sorted(found.items(), key=lambda item: (not item[1].lower().startswith(prefix), len(item[1]), KINDS.index(item[0][0]), item[0][1]))
+        return [(kind, id, name) for (kind, id), name in ranked[:limit]]
+
+
+def load_names():
+    names = [('category', id, name) for id, name in db.session.execute(select(Category.id, Category.category_name))]
+    names += [('product', id, name) for id, name in db.session.execute(select(Product.id, Product.product_name))]
+    return names
+
+
+_index = None
+_index_lock = threading.Lock()
+_rebuilding = threading.Event()
+
+
+'''This worker's index, built on first use and refreshed in the background once it is too old'''
+def get_index():
+    global _index
+
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = PrefixIndex(load_names())
+
+    elif time.monotonic() - _index.built > current_app.config['AUTOCOMPLETE_MAX_AGE'] and not _rebuilding.is_set():
+        _rebuilding.set()
+        threading.Thread(target=_rebuild, args=(current_app._get_current_object(),), name='autocomplete-rebuild', daemon=True).start()
+
+    return _index
+
+
+def _rebuild(app):
+    global _index
+    try:
+        with app.app_context():
+            _index = PrefixIndex(load_names())
+    finally:
+        _rebuilding.clear()
+
+
+'''Suggestions for a typed prefix as (kind, id, name) tuples'''
+def suggest(prefix, limit=None):
+    limit = limit or current_app.config['AUTOCOMPLETE_LIMIT']
+    return get_index().lookup(prefix, limit, current_app.config['AUTOCOMPLETE_CANDIDATES'])
+
+
+############################################################################################################################
+'''
+--------------------------------  INCREMENTAL UPDATES  --------------------------------
+
+Mapper events note each changed product/category name in session.info, and they are applied to
+the index only once the transaction commits, so a rolled back admin write never shows up.
+'''
+############################################################################################################################
+
+
+# model -> (kind, name column)
+INDEXED = {Product: ('product', 'product_name'), Category: ('category', 'category_name')}
+
+
+def _note_change(session, kind, id, name):
+    session.info.setdefault('autocomplete_changes', []).append((kind, id, name))
+
+
+def _indexed_written(mapper, connection, target):
+    kind, column = INDEXED[mapper.class_]
+    _note_change(object_session(target), kind, target.id, getattr(target, column))
+
+
+def _indexed_deleted(mapper, connection, target):
+    kind, _ = INDEXED[mapper.class_]
+    _note_change(object_session(target), kind, target.id, None)
+
+
+'''Note rows removed by a bulk DELETE, which fires no mapper events, to drop them on commit like the others'''
+def forget_names(session, kind, ids):
+    for id in ids:
+        _note_change(session, kind, id, None)
+
+
+def _apply_committed_changes(session):
+    changes = session.info.pop('autocomplete_changes', None)
+    if not changes or _index is None:
+        return
+
+    for kind, id, name in changes:
+        if name is None:
+            _index.remove(kind, id)
+        else:
+            _index.put(kind, id, name)
+
+
+def _drop_rolled_back_changes(session):
+    session.info.pop('autocomplete_changes', None)
+
+
+def init_app(app):
+    app.config.setdefault('AUTOCOMPLETE_LIMIT', 8)
+    app.config.setdefault('AUTOCOMPLETE_MAX_LIMIT', 20)
+    app.config.setdefault('AUTOCOMPLETE_CANDIDATES', 200)
+    app.config.setdefault('AUTOCOMPLETE_MAX_AGE', 300)
+    app.config.setdefault('AUTOCOMPLETE_HTTP_MAX_AGE', 60)
+
+    for model in INDEXED:
+        if not event.contains(model, 'after_insert', _indexed_written):
+            event.listen(model, 'after_insert', _indexed_written)
+            event.listen(model, 'after_update', _indexed_written)
+            event.listen(model, 'after_delete', _indexed_deleted)
+
+    if not event.contains(db.session, 'after_commit', _apply_committed_changes):
+        event.listen(db.session, 'after_commit', _apply_committed_changes)
+        event.listen(db.session, 'after_rollback', _drop_rolled_back_changes)
@@ -0,0 +1,319 @@
+import json
+import os
+import random
+import subprocess
+import time
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import User, Cart, Product, Category, Unit
+
+
+############################################################################################################################
+'''
+--------------------------------  SYNTHETIC CATALOG  --------------------------------
+
+`flask generate-catalog` fills the database with a reproducible catalog (same --seed, same data)
+to measure the app at realistic sizes. Point it at a scratch database, e.g.
+
+    FLASK_SQLALCHEMY_DATABASE_URI=sqlite:///bench.sqlite3 flask generate-catalog --products 100000
+
+Product names are "<variety> <item> <pack size>" with item and variety picked on a Zipf-like curve,
+so a few words (tomato, milk, rice) match thousands of products and most match a handful, like a
+real grocery catalog and unlike uniformly random names.
+'''
+############################################################################################################################
+
+
+ITEMS = [
+    'Tomato', 'Milk', 'Rice', 'Potato', 'Onion', 'Apple', 'Banana', 'Bread', 'Eggs', 'Yogurt', 'Cheese',
+    'Butter', 'Chicken', 'Lentils', 'Flour', 'Sugar', 'Tea', 'Coffee', 'Oil', 'Salt', 'Pasta', 'Orange',
+    'Mango', 'Spinach', 'Carrot', 'Cucumber', 'Garlic', 'Ginger', 'Paneer', 'Oats', 'Honey', 'Juice',
+    'Biscuits', 'Chips', 'Noodles', 'Ketchup', 'Jam', 'Grapes', 'Peas', 'Cauliflower', 'Cabbage', 'Lemon',
+    'Chickpeas', 'Almonds', 'Cashews', 'Raisins', 'Soap', 'Shampoo', 'Detergent', 'Toothpaste',
+]
+VARIETIES = [
+    'Fresh', 'Organic', 'Premium', 'Farm', 'Classic', 'Local', 'Whole', 'Low Fat', 'Cherry', 'Basmati',
+    'Brown', 'Green', 'Red', 'Sweet', 'Spicy', 'Roasted', 'Salted', 'Masala', 'Golden', 'Baby', 'Natural',
+    'Extra Virgin', 'Crunchy', 'Family', 'Value',
+]
+PACK_SIZES = ['100g', '250g', '500g', '1kg', '2kg', '5kg', '200ml', '500ml', '1L', '2L', '6 pack', '12 pack']
+CATEGORY_NAMES = [
+    'Fruits', 'Vegetables', 'Dairy', 'Bakery', 'Beverages', 'Snacks', 'Staples', 'Meat', 'Frozen', 'Personal Care',
+    'Household', 'Breakfast', 'Spices', 'Dry Fruits', 'Sauces', 'Sweets', 'Baby Care', 'Pet Care', 'Organic', 'Instant Food',
+]
+UNIT_NAMES = ['kg', 'g', 'L', 'ml', 'piece', 'dozen', 'pack', 'box', 'bottle', 'bunch']
+
+# Password of every generated user
+SYNTHETIC_PASSWORD = 'password1'
+
+
+def zipf_weights(count, exponent=1.1):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def _numbered(names, count):
+    return [names[i] if i < len(names) else '%s %d' % (names[i % len(names)], i // len(names) + 1) for i in range(count)]
+
+
+def _batches(rows, size=5000):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+'''count unique product names'''
+def product_names(rng, count):
+    item_weights, variety_weights = zipf_weights(len(ITEMS)), zipf_weights(len(VARIETIES))
+    names, seen = [], set()
+    while len(names) < count:
+        item = rng.choices(ITEMS, item_weights)[0]
+        variety = rng.choices(VARIETIES, variety_weights)[0]
+        name = '%s %s %s' % (variety, item, rng.choice(PACK_SIZES))
+        if name in seen:
+            name = '%s %d' % (name, len(names))
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+'''Insert a synthetic catalog, returning the number of rows made per table'''
+def generate_catalog(categories=20, units=10, products=10000, users=100, carts=1000, seed=42):
+    from flask_bcrypt import Bcrypt
+    from .images import PLACEHOLDER_PICTURE
+
+    rng = random.Random(seed)
+    connection = db.session.connection()
+
+    def add_named(model, column, names, **defaults):
+        rows = [dict({column: name}, **defaults) for name in names]
+        connection.execute(sqlite_insert(model.__table__).on_conflict_do_nothing(), rows)
+        return [id for id, in db.session.execute(select(model.id).where(getattr(model, column).in_(names)))]
+
+    category_ids = add_named(Category, 'category_name', _numbered(CATEGORY_NAMES, categories), category_picture=PLACEHOLDER_PICTURE)
+    unit_ids = add_named(Unit, 'unit_name', _numbered(UNIT_NAMES, units))
+
+    # Most stock is plentiful; a tail is nearly sold out, like a real store
+    first_day = date(2023, 1, 1)
+    product_rows = [{
+        'product_name': name,
+        'product_picture': PLACEHOLDER_PICTURE,
+        'total_quantity': rng.choice([rng.randint(1000, 100000)] * 9 + [rng.randint(0, 10)]),
+        'rate_per_unit': int(rng.lognormvariate(4.5, 0.9)) % 100000,
+        'manufacture_date': first_day + timedelta(days=rng.randint(0, 365)),
+        'unit_id': rng.choice(unit_ids),
+        'category_id': rng.choice(category_ids),
+    } for name in product_names(rng, products)]
+    for batch in _batches(product_rows):
+        connection.execute(sqlite_insert(Product.__table__).on_conflict_do_nothing(), batch)
+
+    # One bcrypt hash shared by every user, hashing each would take minutes
+    password_hash = Bcrypt().generate_password_hash(SYNTHETIC_PASSWORD).decode('utf-8')
+    usernames = ['shopper%06d' % number for number in range(users)]
+    user_ids = add_named(User, 'username', usernames, password_hash=password_hash)
+
+    product_count = db.session.execute(select(func.max(Product.id))).scalar() or 0
+    cart_rows = [{'user_id': rng.choice(user_ids), 'prod_id': rng.randint(1, product_count), 'product_quantity': rng.randint(1, 5)}
+                 for _ in range(carts if user_ids and product_count else 0)]
+    for batch in _batches(cart_rows):
+        connection.execute(sqlite_insert(Cart.__table__).on_conflict_do_nothing(), batch)
+
+    db.session.commit()
+    return {'categories': len(category_ids), 'units': len(unit_ids), 'products': len(product_rows),
+            'users': len(user_ids), 'carts': len(cart_rows)}
+
+
+@click.command('generate-catalog')
+@click.option('--categories', type=click.IntRange(1), default=20, show_default=True)
+@click.option('--units', type=click.IntRange(1), default=10, show_default=True)
+@click.option('--products', type=click.IntRange(0), default=10000, show_default=True)
+@click.option('--users', type=click.IntRange(0), default=100, show_default=True)
+@click.option('--carts', type=click.IntRange(0), default=1000, show_default=True, help='Cart lines spread over the users.')
+@click.option('--seed', type=int, default=42, show_default=True, help='Same seed, same catalog.')
+@with_appcontext
+def generate_catalog_command(categories, units, products, users, carts, seed):
+    '''Fill the database with a synthetic catalog for benchmarks.'''
+    from .cache import catalog_changed
+
+    started = time.monotonic()
+    made = generate_catalog(categories, units, products, users, carts, seed)
+    catalog_changed('categories', 'units')
+
+    click.echo(', '.join('%d %s' % (count, table) for table, count in made.items()) + ' in %.1fs' % (time.monotonic() - started))
+    click.echo('Users are shopper000000, shopper000001, ... with password "%s".' % SYNTHETIC_PASSWORD)
+
+
+############################################################################################################################
+'''
+--------------------------------  BENCHMARK  --------------------------------
+
+`flask benchmark` drives the main routes through the Flask test client (the whole app, no network)
+and reports throughput and p50/p95/p99 latency per route. --save NAME stores the results as
+benchmarks/NAME.json (commit them), --compare NAME prints the change against a saved run.
+
+It adds to carts and buys, so run it against a generated database, not a real one.
+'''
+############################################################################################################################
+
+
+BENCHMARK_ROUTES = ('home', 'search', 'category', 'product', 'cart', 'add_to_cart', 'purchase_all')
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = max(0, int(round(percent / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+'''Latency percentiles of the timed requests, and their throughput leaving out untimed setup and checks'''
+def summarize(durations):
+    elapsed = sum(durations)
+    durations = sorted(durations)
+    return {
+        'requests': len(durations),
+        'rps': len(durations) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(durations) / len(durations) * 1000 if durations else 0.0,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p95_ms': percentile(durations, 95) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+    }
+
+
+class Scenario:
+    '''Requests of each benchmarked route, with random but reproducible ids and search words.'''
+
+    def __init__(self, client, rng, product_ids, category_ids):
+        self.client = client
+        self.rng = rng
+        self.product_ids = product_ids
+        self.category_ids = category_ids
+
+    def home(self):
+        return self.client.get('/')
+
+    def search(self):
+        word = self.rng.choices(ITEMS, zipf_weights(len(ITEMS)))[0].lower()
+        return self.client.get('/search', query_string={'query': word})
+
+    def category(self):
+        return self.client.get('/category/%d' % self.rng.choice(self.category_ids))
+
+    def product(self):
+        return self.client.get('/product/%d' % self.rng.choice(self.product_ids))
+
+    def cart(self):
+        return self.client.get('/cart')
+
+    def add_to_cart(self):
+        return self.client.post('/add_to_cart/%d' % self.rng.choice(self.product_ids), data={'quantity': 1})
+
+    def purchase_all(self):
+        # Untimed setup: something to buy
+        self.add_to_cart()
+        started = time.perf_counter()
+        response = self.client.post('/purchase_all')
+        return response, time.perf_counter() - started
+
+
+'''
+Pop the messages flashed by the requests so far, returning True if one is an error. The app
+refuses a purchase or an add to cart with a redirect and an error message, not a 4xx.
+'''
+def refused(client):
+    with client.session_transaction() as session:
+        flashes = session.pop('_flashes', [])
+    return any(category == 'error' for category, _ in flashes)
+
+
+def run_benchmark(routes=BENCHMARK_ROUTES, requests=200, warmup=20, seed=42):
+    rng = random.Random(seed)
+    user = User.query.order_by(User.id).first()
+    product_ids = [id for id, in db.session.execute(select(Product.id).where(Product.total_quantity > 10))]
+    category_ids = [id for id, in db.session.execute(select(Category.id))]
+    if user is None or not product_ids or not category_ids:
+        raise click.ClickException('The database has no users or products, run flask generate-catalog first.')
+
+    client = current_app.test_client()
+    with client.session_transaction() as session:
+        # Logged in without bcrypt, login itself is not benchmarked
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+        session['user_type'] = 'user'
+
+    scenario = Scenario(client, rng, product_ids, category_ids)
+    results = {}
+    for route in routes:
+        request = getattr(scenario, route)
+        for _ in range(warmup):
+            request()
+        refused(client)
+
+        durations, errors = [], 0
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = request()
+            duration = time.perf_counter() - started
+            if isinstance(response, tuple):
+                response, duration = response
+            durations.append(duration)
+            if response.status_code >= 400 or refused(client):
+                errors += 1
+
+        results[route] = dict(summarize(durations), errors=errors)
+        db.session.remove()
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def baseline_path(name):
+    return os.path.join(os.path.dirname(current_app.root_path), 'benchmarks', '%s.json' % name)
+
+
+@click.command('benchmark')
+@click.option('--routes', default=','.join(BENCHMARK_ROUTES), show_default=True, help='Comma separated routes to run.')
+@click.option('--requests', type=click.IntRange(1), default=200, show_default=True, help='Timed requests per route.')
+@click.option('--warmup', type=click.IntRange(0), default=20, show_default=True, help='Untimed requests per route first.')
+@click.option('--seed', type=int, default=42, show_default=True)
+@click.option('--save', 'save_as', default=None, help='Save the results as benchmarks/NAME.json.')
+@click.option('--compare', 'compare_to', default=None, help='Compare with benchmarks/NAME.json.')
+@with_appcontext
+def benchmark_command(routes, requests, warmup, seed, save_as, compare_to):
+    '''Measure throughput and latency percentiles of the main routes.'''
+    routes = [route.strip() for route in routes.split(',') if route.strip()]
+    unknown = [route for route in routes if route not in BENCHMARK_ROUTES]
+    if unknown:
+        raise click.BadParameter('unknown routes %s, choose from %s' % (', '.join(unknown), ', '.join(BENCHMARK_ROUTES)))
+
+    baseline = None
+    if compare_to:
+        with open(baseline_path(compare_to)) as file:
+            baseline = json.load(file)['routes']
+
+    results = run_benchmark(routes, requests, warmup, seed)
+
+    click.echo('%-14s %9s %9s %9s %9s %7s%s' % ('route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', '   vs p50 / p95' if baseline else ''))
+    for route, result in results.items():
+        line = '%-14s %9.1f %9.2f %9.2f %9.2f %7d' % (route, result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors'])
+        if baseline and route in baseline:
+            change = lambda key: (result[key] / baseline[route][key] - 1) * 100 if baseline[route][key] else 0.0
+            line += '   %+6.1f%% / %+6.1f%%' % (change('p50_ms'), change('p95_ms'))
+        click.echo(line)
+
+    if save_as:
+        path = baseline_path(save_as)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump({'name': save_as, 'commit': _git_commit(), 'created': datetime.now().isoformat(timespec='seconds'),
+                       'requests': requests, 'seed': seed, 'routes': results}, file, indent=2)
+        click.echo('Saved %s' % path)
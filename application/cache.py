@@ -0,0 +1,314 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from .metrics import CACHE_REQUESTS
+
+
+############################################################################################################################
+'''
+--------------------------------  CACHE BACKENDS  --------------------------------
+'''
+############################################################################################################################
+
+
+class LRUCache:
+    '''Thread-safe in-process cache, bounded to maxsize entries, each expiring after ttl seconds.'''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    # Counters (namespace versions) are kept apart from the entries so they are never evicted
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache:
+    '''Shared cache for running several workers, values are stored as JSON.'''
+
+    def __init__(self, url, prefix='quickgrocer:', ttl=None):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+############################################################################################################################
+'''
+--------------------------------  VERSIONED READ-THROUGH CACHE  --------------------------------
+'''
+############################################################################################################################
+
+
+class Cache:
+    '''
+    Read-through cache whose entries live in namespaces with a version counter. Writers call
+    bump(namespace) after committing, which moves readers onto fresh keys; the old entries are
+    never read again and age out of the LRU (or expire in Redis).
+
+    The default backend is per-process. With several workers set CACHE_REDIS_URL so a bump in one
+    worker is seen by all of them; otherwise CACHE_DEFAULT_TTL bounds how stale other workers get.
+    '''
+
+    def __init__(self, app=None):
+        self.backend = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_REDIS_URL', None)
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 4096)
+
+        if app.config['CACHE_REDIS_URL']:
+            self.backend = RedisCache(app.config['CACHE_REDIS_URL'], ttl=app.config['CACHE_DEFAULT_TTL'])
+        else:
+            self.backend = LRUCache(maxsize=app.config['CACHE_MAX_ENTRIES'], ttl=app.config['CACHE_DEFAULT_TTL'])
+        app.extensions['cache'] = self
+
+    def version(self, namespace):
+        return self.backend.counter('version:' + namespace)
+
+    def bump(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.incr('version:' + namespace)
+
+    def remember(self, namespace, key, loader, ttl=None):
+        versioned_key = '%s:%s:%s' % (namespace, self.version(namespace), key)
+        value = self.backend.get(versioned_key)
+        CACHE_REQUESTS.inc(namespace=namespace, result='miss' if value is None else 'hit')
+        if value is None:
+            value = loader()
+            self.backend.set(versioned_key, value, ttl)
+        return value
+
+
+cache = Cache()
+
+
+############################################################################################################################
+'''
+--------------------------------  REFERENCE DATA  --------------------------------
+
+Categories and units change only when an admin edits them, so the pages that list them read
+plain-dict snapshots from the cache. Templates use them exactly like the model objects
+(category.category_name, unit.unit_name); auth_admin bumps the namespace after every write.
+'''
+############################################################################################################################
+
+
+'''Plain-dict copy of a Category, as cached'''
+def category_snapshot(category):
+    return {'id': category.id, 'category_name': category.category_name, 'category_picture': category.category_picture,
+            'category_picture_variants': category.category_picture_variants}
+
+
+def _load_categories():
+    from .models import Category
+    return [category_snapshot(category) for category in Category.query.order_by(Category.id)]
+
+
+def _load_units():
+    from .models import Unit
+    return [{'id': unit.id, 'unit_name': unit.unit_name} for unit in Unit.query.order_by(Unit.id)]
+
+
+'''All categories, cached until a category is created, edited or deleted'''
+def get_categories():
+    return cache.remember('categories', 'all', _load_categories)
+
+
+'''A single category from the cached list, None if it does not exist'''
+def get_category(category_id):
+    for category in get_categories():
+        if category['id'] == category_id:
+            return category
+    return None
+
+
+'''All units, cached until a unit is created, edited or deleted'''
+def get_units():
+    return cache.remember('units', 'all', _load_units)
+
+
+'''Invalidate everything derived from the catalog after a committed write, plus any extra namespaces'''
+def catalog_changed(*namespaces):
+    cache.bump('catalog', *namespaces)
+
+
+############################################################################################################################
+'''
+--------------------------------  RENDERED FRAGMENTS  --------------------------------
+
+The catalog parts of the home and category pages are cached as rendered HTML under the 'catalog'
+namespace, so a hit skips both the queries and the Jinja work. Only the page shell (navbar login
+state and flashed messages in base.html) is rendered per request.
+'''
+############################################################################################################################
+
+
+'''
+The only query args a cached fragment may depend on: the pagination cursors and the capped page size.
+Fragments build their links from these too, so no other arg of the request that rendered one (filters,
+tracking parameters) ends up in the copy every later visitor gets.
+'''
+def fragment_args():
+    from flask import request
+    from .pagination import page_size
+    args = {key: request.args[key] for key in ('after', 'before') if request.args.get(key)}
+    if 'per_page' in request.args:
+        args['per_page'] = page_size()
+    return args
+
+
+'''Cache key for the current request: path plus fragment_args()'''
+def fragment_key(name):
+    from flask import request
+    from urllib.parse import urlencode
+    return 'fragment:%s:%s?%s' % (name, request.path, urlencode(sorted(fragment_args().items())))
+
+
+'''Rendered HTML of a catalog fragment, calling render() only when it is not cached for this catalog version'''
+def cached_fragment(name, render):
+    from markupsafe import Markup
+    return Markup(cache.remember('catalog', fragment_key(name), render))
+
+
+############################################################################################################################
+'''
+--------------------------------  LOGIN IDENTITY  --------------------------------
+
+flask-login reloads the current User/Admin on every request. The loader keeps a snapshot of the
+row (without the password hash) and merges it into the session without a query, so a cache hit
+behaves like the real object and relationships such as user.cart still lazy-load. Snapshots are
+dropped on logout and whenever a User/Admin row is updated or deleted.
+'''
+############################################################################################################################
+
+
+# user_type in the session -> (model name, columns kept in the snapshot)
+IDENTITY_COLUMNS = {
+    'user': ('User', ('id', 'username')),
+    'admin': ('Admin', ('id', 'admin_name')),
+}
+
+
+def _identity_key(user_type, user_id):
+    return 'identity:%s:%s' % (user_type, user_id)
+
+
+def _identity_model(user_type):
+    from . import models
+    model_name, columns = IDENTITY_COLUMNS[user_type]
+    return getattr(models, model_name), columns
+
+
+'''The logged in User/Admin for user_loader, from its cached snapshot when there is one'''
+def load_identity(user_type, user_id):
+    from flask import current_app
+    from sqlalchemy.orm import make_transient_to_detached
+    from . import db
+
+    if user_type not in IDENTITY_COLUMNS:
+        return None
+
+    model, columns = _identity_model(user_type)
+    key = _identity_key(user_type, user_id)
+    snapshot = cache.backend.get(key)
+    CACHE_REQUESTS.inc(namespace='identity', result='miss' if snapshot is None else 'hit')
+
+    if snapshot is None:
+        identity = db.session.get(model, int(user_id))
+        if identity is not None:
+            cache.backend.set(key, {column: getattr(identity, column) for column in columns},
+                              current_app.config['IDENTITY_CACHE_TTL'])
+        return identity
+
+    identity = model(**snapshot)
+    make_transient_to_detached(identity)
+    return db.session.merge(identity, load=False)
+
+
+'''Drop the cached snapshot of a User/Admin'''
+def forget_identity(user_type, user_id):
+    cache.backend.delete(_identity_key(user_type, user_id))
+
+
+def _forget_changed_identity(mapper, connection, target):
+    forget_identity('admin' if target.is_admin() else 'user', target.id)
+
+
+def init_identity_cache(app):
+    from sqlalchemy import event
+
+    app.config.setdefault('IDENTITY_CACHE_TTL', 300)
+
+    for user_type in IDENTITY_COLUMNS:
+        model, _ = _identity_model(user_type)
+        if not event.contains(model, 'after_update', _forget_changed_identity):
+            event.listen(model, 'after_update', _forget_changed_identity)
+            event.listen(model, 'after_delete', _forget_changed_identity)
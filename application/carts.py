@@ -0,0 +1,39 @@
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import Cart
+
+
+############################################################################################################################
+'''
+--------------------------------  CART LINES  --------------------------------
+
+A user has at most one line per product (unique index ix_cart_user_product), and every write here
+is a single statement, so concurrent clicks cannot race each other into duplicate lines or lost
+increments. Callers commit.
+'''
+############################################################################################################################
+
+
+'''
+Add quantity of a product to a user's cart, creating the line or adding to the one already there
+(INSERT ... ON CONFLICT DO UPDATE). Returns the line's (id, product_quantity).
+'''
+def save_line(user_id, product_id, quantity):
+    statement = sqlite_insert(Cart).values(user_id=user_id, prod_id=product_id, product_quantity=quantity)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Cart.user_id, Cart.prod_id],
+        set_={'product_quantity': Cart.product_quantity + statement.excluded.product_quantity},
+    ).returning(Cart.id, Cart.product_quantity)
+
+    return db.session.execute(statement, execution_options={'synchronize_session': False}).one()
+
+
+'''Set the quantity of one of a user's cart lines, returning False if the user has no such line'''
+def set_quantity(user_id, cart_id, quantity):
+    result = db.session.execute(
+        update(Cart)
+        .where(Cart.id == cart_id, Cart.user_id == user_id)
+        .values(product_quantity=quantity),
+        execution_options={'synchronize_session': False})
+    return result.rowcount == 1
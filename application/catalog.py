@@ -0,0 +1,355 @@
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import Product, Category, Unit
+from .images import PLACEHOLDER_PICTURE, content_hash, make_thumbnail, make_variants, images_dir
+
+
+############################################################################################################################
+'''
+--------------------------------  BULK IMPORT  --------------------------------
+
+`flask import-catalog products.csv` loads products from CSV (with a header row) or JSON lines, one
+product per row, with the fields:
+
+    product_name, category, unit, total_quantity, rate_per_unit, manufacture_date[, picture]
+
+Category and unit are names, resolved through an in-memory map loaded once. The file is read as a
+stream and inserted in batches, one executemany INSERT and one commit per batch, so memory use does
+not grow with the file. Rows are validated with the same limits as the admin product form; invalid
+rows and names already in the catalog are skipped and reported, the rest of the file still loads.
+'''
+############################################################################################################################
+
+
+# Limits of the admin product form
+MAX_TOTAL_QUANTITY = 1000000
+MAX_RATE_PER_UNIT = 100000
+PICTURE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.svg')
+
+
+class RowError(ValueError):
+    pass
+
+
+'''Yield (line number, row) from a CSV or JSON lines file; a JSON line that does not parse is yielded as None'''
+def read_rows(file, file_format):
+    if file_format == 'csv':
+        for number, row in enumerate(csv.DictReader(file), start=2):
+            yield number, row
+        return
+
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+'''{lowercased name: id} of every row of a reference table'''
+def name_map(model, column):
+    return {name.lower(): id for id, name in db.session.query(model.id, getattr(model, column))}
+
+
+def _resolve(names, model, column, value, create_missing, **defaults):
+    name = str(value or '').strip()
+    if not name:
+        raise RowError('missing %s' % model.__tablename__)
+
+    if name.lower() not in names:
+        if not create_missing:
+            raise RowError('unknown %s "%s"' % (model.__tablename__, name))
+        names[name.lower()] = db.session.execute(insert(model).values(**{column: name}, **defaults)).inserted_primary_key[0]
+
+    return names[name.lower()]
+
+
+def _number(row, field, maximum):
+    try:
+        value = int(str(row.get(field, '')).strip())
+    except ValueError:
+        raise RowError('%s is not a whole number' % field)
+
+    if value < 0 or value > maximum:
+        raise RowError('%s must be between 0 and %d' % (field, maximum))
+    return value
+
+
+'''Check one row and turn it into the values of a product INSERT, raising RowError if it is invalid'''
+def validate_row(row, categories, units, create_missing=False, today=None):
+    if row is None:
+        raise RowError('not a JSON object')
+
+    product_name = str(row.get('product_name') or '').strip()
+    if len(product_name) < 3 or len(product_name) > 40:
+        raise RowError('product_name must be 3 to 40 characters')
+
+    try:
+        manufacture_date = datetime.strptime(str(row.get('manufacture_date') or '').strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise RowError('manufacture_date must be YYYY-MM-DD')
+    if manufacture_date > (today or datetime.now().date()):
+        raise RowError('manufacture_date cannot be in the future')
+
+    picture = str(row.get('picture') or '').strip()
+    if picture and not picture.lower().endswith(PICTURE_EXTENSIONS):
+        raise RowError('picture must be svg, webp, png, jpg or jpeg')
+
+    return {
+        'product_name': product_name,
+        'total_quantity': _number(row, 'total_quantity', MAX_TOTAL_QUANTITY),
+        'rate_per_unit': _number(row, 'rate_per_unit', MAX_RATE_PER_UNIT),
+        'manufacture_date': manufacture_date,
+        'category_id': _resolve(categories, Category, 'category_name', row.get('category'), create_missing,
+                                category_picture=PLACEHOLDER_PICTURE),
+        'unit_id': _resolve(units, Unit, 'unit_name', row.get('unit'), create_missing),
+        'product_picture': picture or PLACEHOLDER_PICTURE,
+        'product_picture_variants': None,
+    }
+
+
+'''
+Make the catalog picture and variants of a local image file, named by content like an upload, and
+return them as (picture, variants). Runs on the import's worker threads; Pillow releases the GIL
+while it decodes and resizes, so the threads do overlap.
+'''
+def ingest_picture(source, directory):
+    _, f_ext = os.path.splitext(source)
+    with open(source, 'rb') as file:
+        picture = content_hash(file) + f_ext.lower()
+
+    picture_path = os.path.join(directory, picture)
+    if not os.path.exists(picture_path):
+        make_thumbnail(source, picture_path)
+    return picture, make_variants(source, picture, directory)
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.errors = []
+        self.error_count = 0
+        self.missing_pictures = 0
+
+    def error(self, number, message, keep=20):
+        self.error_count += 1
+        if len(self.errors) < keep:
+            self.errors.append('line %d: %s' % (number, message))
+
+    @property
+    def rate(self):
+        return self.read / max(time.monotonic() - self.started, 1e-6)
+
+    def __str__(self):
+        return '%d rows read, %d inserted, %d already in the catalog, %d invalid in %.1fs (%d rows/s)' % (
+            self.read, self.inserted, self.duplicates, self.error_count, time.monotonic() - self.started, self.rate)
+
+
+def _picture_for(values, images, directory):
+    source = os.path.join(images, values['product_picture'])
+    try:
+        return ingest_picture(source, directory)
+    except Exception:
+        # Missing or unreadable file
+        return None
+
+
+def _insert_batch(batch, images, directory, executor, stats):
+    if images:
+        with_picture = [values for values in batch if values['product_picture'] != PLACEHOLDER_PICTURE]
+        made = executor.map(lambda values: _picture_for(values, images, directory), with_picture)
+        for values, picture in zip(with_picture, made):
+            if picture is None:
+                stats.missing_pictures += 1
+                picture = (PLACEHOLDER_PICTURE, None)
+            values['product_picture'], values['product_picture_variants'] = picture
+
+    # Names already in the catalog (or repeated in the file) are skipped, not failed
+    statement = sqlite_insert(Product.__table__).on_conflict_do_nothing(index_elements=['product_name'])
+    result = db.session.connection().execute(statement, batch)
+    db.session.commit()
+
+    stats.inserted += result.rowcount
+    stats.duplicates += len(batch) - result.rowcount
+
+
+'''Stream a catalog file into the product table, returning an ImportStats'''
+def import_catalog(file, file_format='csv', images=None, batch_size=5000, workers=4, create_missing=False, progress=None):
+    stats = ImportStats()
+    categories = name_map(Category, 'category_name')
+    units = name_map(Unit, 'unit_name')
+    today = datetime.now().date()
+    directory = images_dir()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for number, row in read_rows(file, file_format):
+            stats.read += 1
+            try:
+                values = validate_row(row, categories, units, create_missing, today)
+            except RowError as error:
+                stats.error(number, error)
+                continue
+
+            if not images:
+                values['product_picture'] = PLACEHOLDER_PICTURE
+            batch.append(values)
+
+            if len(batch) >= batch_size:
+                _insert_batch(batch, images, directory, executor, stats)
+                batch = []
+                if progress:
+                    progress(stats)
+
+        if batch:
+            _insert_batch(batch, images, directory, executor, stats)
+        db.session.commit()
+
+    return stats
+
+
+@click.command('import-catalog')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='File format, guessed from the file extension by default.')
+@click.option('--images', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Directory the picture column is relative to. Without it every product gets the placeholder.')
+@click.option('--batch-size', type=click.IntRange(1), default=5000, show_default=True, help='Rows per transaction.')
+@click.option('--workers', type=click.IntRange(1), default=4, show_default=True, help='Threads making pictures.')
+@click.option('--create-missing', is_flag=True, help='Create categories and units that do not exist yet.')
+@with_appcontext
+def import_catalog_command(file, file_format, images, batch_size, workers, create_missing):
+    '''Bulk load products from a CSV or JSON lines file.'''
+    from .cache import catalog_changed
+
+    if file_format is None:
+        file_format = 'jsonl' if file.name.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+    def progress(stats):
+        click.echo('%d rows, %d rows/s' % (stats.read, stats.rate))
+
+    stats = import_catalog(file, file_format, images, batch_size, workers, create_missing, progress)
+    catalog_changed('categories', 'units')
+
+    for error in stats.errors:
+        click.echo(error, err=True)
+    if stats.error_count > len(stats.errors):
+        click.echo('... and %d more invalid rows' % (stats.error_count - len(stats.errors)), err=True)
+    if stats.missing_pictures:
+        click.echo('%d pictures could not be read, those products use the placeholder' % stats.missing_pictures, err=True)
+    click.echo(str(stats))
+
+
+############################################################################################################################
+'''
+--------------------------------  STREAMING EXPORT  --------------------------------
+
+Exports are generated row by row from a cursor fetched in chunks, so a full snapshot of the catalog
+takes constant memory and the first bytes go out before the last row is read. The columns are the
+ones import-catalog reads (plus id), so an export can be loaded into another database as it is.
+'''
+############################################################################################################################
+
+
+EXPORT_FIELDS = ('id', 'product_name', 'category', 'unit', 'total_quantity', 'rate_per_unit', 'manufacture_date', 'picture')
+
+EXPORT_CHUNK_ROWS = 500
+
+
+'''Rows of the export, with the same optional filters as the search page'''
+def export_rows(query=None, price=None, date_filter=None, category_id=None):
+    from .search import search_products, filter_products
+
+    products = db.session.query(
+        Product.id, Product.product_name, Category.category_name, Unit.unit_name, Product.total_quantity,
+        Product.rate_per_unit, Product.manufacture_date, Product.product_picture,
+    ).join(Product.category).join(Product.unit)
+
+    products = search_products(products, query) if query else products.order_by(Product.id)
+    products = filter_products(products, price=price, date_filter=date_filter, category_id=category_id)
+    return products.yield_per(1000)
+
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+
+    for number, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if number % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export_ndjson(rows):
+    lines = []
+    for row in rows:
+        values = dict(zip(EXPORT_FIELDS, row))
+        values['manufacture_date'] = values['manufacture_date'].isoformat()
+        lines.append(json.dumps(values) + '\n')
+
+        if len(lines) == EXPORT_CHUNK_ROWS:
+            yield ''.join(lines)
+            lines = []
+
+    yield ''.join(lines)
+
+
+# format -> (generator, mimetype)
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
+
+############################################################################################################################
+'''
+--------------------------------  CASCADE DELETE  --------------------------------
+
+Deleting a category removes its products and their cart lines with one DELETE statement each, in
+the caller's transaction, however many products it holds. Their pictures are only discarded here:
+the files are removed in the background after the commit, once nothing else uses them.
+'''
+############################################################################################################################
+
+
+'''Delete a category with its products and their cart lines, returning how many products went'''
+def delete_category_cascade(category):
+    from sqlalchemy import delete, select
+    from .autocomplete import forget_names
+    from .images import discard_picture
+    from .models import Cart
+
+    in_category = select(Product.id).where(Product.category_id == category.id)
+    pictures = db.session.execute(select(Product.product_picture).where(Product.category_id == category.id).distinct()).scalars().all()
+
+    db.session.execute(delete(Cart.__table__).where(Cart.__table__.c.prod_id.in_(in_category)))
+    product_ids = db.session.execute(delete(Product.__table__).where(Product.__table__.c.category_id == category.id)
+                                     .returning(Product.__table__.c.id)).scalars().all()
+
+    # Core deletes fire no mapper events, so the autocomplete index is told directly
+    forget_names(db.session(), 'product', product_ids)
+
+    for picture in pictures + [category.category_picture]:
+        discard_picture(picture)
+    db.session.delete(category)
+    return len(product_ids)
@@ -0,0 +1,145 @@
+from collections import namedtuple
+from sqlalchemy import select, update, delete, func
+from . import db
+from .models import Cart, Product, cart_details
+
+
+############################################################################################################################
+'''
+--------------------------------  CHECKOUT  --------------------------------
+
+Stock is never read into Python, changed and written back. Every decrement is a conditional
+UPDATE ... SET total_quantity = total_quantity - q WHERE total_quantity >= q, so two shoppers
+racing for the last items cannot both succeed and a purchase can never drive stock negative.
+'''
+############################################################################################################################
+
+
+# A cart line (or direct purchase) that could not be bought
+LineFailure = namedtuple('LineFailure', ['product_name', 'requested', 'available'])
+
+# The failure of a purchase that did not go through although every line had the stock, because the
+# cart changed while it was being bought (a line removed or edited in another tab)
+CART_CHANGED = LineFailure(None, 0, 0)
+
+
+class CheckoutResult:
+    def __init__(self, lines, total_bill=0, failures=()):
+        self.lines = lines
+        self.total_bill = total_bill
+        self.failures = list(failures)
+
+    @property
+    def ok(self):
+        return bool(self.lines) and not self.failures
+
+    def __repr__(self):
+        return '<CheckoutResult %r lines, %r failures>' % (len(self.lines), len(self.failures))
+
+
+'''Load a user's cart lines (optionally only some of them) with their products in one joined query'''
+def load_cart(user_id, cart_ids=None):
+    carts = Cart.query.options(*cart_details()).filter(Cart.user_id == user_id)
+    if cart_ids is not None:
+        carts = carts.filter(Cart.id.in_(cart_ids))
+    return carts.order_by(Cart.id).all()
+
+
+'''Total price of the given cart lines'''
+def cart_total(lines):
+    return sum(line.product_quantity * line.product.rate_per_unit for line in lines)
+
+
+'''Current stock of the given products, as {product_id: total_quantity}'''
+def stock_levels(product_ids):
+    rows = db.session.execute(select(Product.id, Product.total_quantity).where(Product.id.in_(product_ids)))
+    return dict(rows.all())
+
+
+'''
+Buy a user's whole cart, or only the lines in cart_ids, as a single transaction.
+
+Three statements regardless of cart size: one joined SELECT of the lines, one set-based conditional
+UPDATE of stock for every product in the cart, and one DELETE of the bought lines. If any product no
+longer has enough stock nothing is bought, the transaction is rolled back and the result lists the
+lines that could not be filled. If the stock was there but the cart changed meanwhile, nothing is
+bought either and the only failure is CART_CHANGED.
+'''
+def checkout(user_id, cart_ids=None):
+    lines = load_cart(user_id, cart_ids)
+    if not lines:
+        return CheckoutResult(lines)
+
+    total_bill = cart_total(lines)
+
+    invalid = [line for line in lines if line.product_quantity <= 0]
+    if invalid:
+        return CheckoutResult(lines, total_bill, [
+            LineFailure(line.product.product_name, line.product_quantity, line.product.total_quantity) for line in invalid])
+
+    line_ids = [line.id for line in lines]
+    product_ids = {line.prod_id for line in lines}
+    snapshot = [(line.product.product_name, line.prod_id, line.product_quantity) for line in lines]
+    requested = {}
+    for line in lines:
+        requested[line.prod_id] = requested.get(line.prod_id, 0) + line.product_quantity
+
+    # Quantity of each product across the bought lines, correlated to the product row being updated
+    quantity = select(func.sum(Cart.product_quantity)) \
+        .where(Cart.id.in_(line_ids), Cart.prod_id == Product.id) \
+        .scalar_subquery()
+
+    try:
+        result = db.session.execute(
+            update(Product)
+            .where(Product.id.in_(product_ids), Product.total_quantity >= quantity)
+            .values(total_quantity=Product.total_quantity - quantity),
+            execution_options={'synchronize_session': False})
+
+        if result.rowcount != len(product_ids):
+            db.session.rollback()
+
+            # The rollback expired the loaded lines, so only the snapshot taken above is used here
+            available = stock_levels(product_ids)
+            failures = [LineFailure(name, line_quantity, available.get(prod_id, 0))
+                        for name, prod_id, line_quantity in snapshot
+                        if available.get(prod_id, 0) < requested[prod_id]]
+            return CheckoutResult(lines, total_bill, failures or [CART_CHANGED])
+
+        db.session.execute(delete(Cart).where(Cart.id.in_(line_ids)), execution_options={'synchronize_session': False})
+        db.session.commit()
+
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return CheckoutResult(lines, total_bill)
+
+
+'''Buy a product directly (without a cart line), with the same conditional stock decrement'''
+def buy_product(product, quantity):
+    product_id, name = product.id, product.product_name
+    if quantity <= 0:
+        return CheckoutResult([product], 0, [LineFailure(name, quantity, product.total_quantity)])
+
+    total_bill = quantity * product.rate_per_unit
+
+    try:
+        result = db.session.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.total_quantity >= quantity)
+            .values(total_quantity=Product.total_quantity - quantity),
+            execution_options={'synchronize_session': False})
+
+        if result.rowcount != 1:
+            db.session.rollback()
+            available = stock_levels([product_id]).get(product_id, 0)
+            return CheckoutResult([product], 0, [LineFailure(name, quantity, available)])
+
+        db.session.commit()
+
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return CheckoutResult([product], total_bill)
@@ -0,0 +1,110 @@
+import random
+import time
+from functools import wraps
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from . import db
+
+
+############################################################################################################################
+'''
+--------------------------------  SQLITE ENGINE PROFILE  --------------------------------
+
+With the default rollback journal a writer locks readers out of the whole file. The 'production'
+profile switches the database to WAL, where readers keep reading the last committed state while one
+writer appends, and tunes every new connection for a read-heavy catalog. Several workers can then
+share the one database file; writers still queue, waiting up to SQLITE_BUSY_TIMEOUT for the lock.
+'''
+############################################################################################################################
+
+
+# Pragmas run on every new connection, per DATABASE_PROFILE
+PROFILES = {
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',    # fsync at checkpoints only, safe with WAL
+        'cache_size': -64000,       # 64MB page cache per connection
+        'mmap_size': 268435456,     # read the first 256MB of the file through mmap
+        'temp_store': 'MEMORY',
+    },
+    'default': {},
+}
+
+
+'''True for a database kept in a file, False for an in-memory one (sqlite://, :memory:, mode=memory)'''
+def is_file_database(uri):
+    url = make_url(uri)
+    return url.database not in (None, '', ':memory:') and url.query.get('mode') != 'memory'
+
+
+'''
+Engine options (busy timeout and pool sizing) for db.init_app, from the app config. An in-memory
+database gets SQLAlchemy's StaticPool, which takes no pool sizing, so it only gets the timeout.
+'''
+def configure(app):
+    app.config.setdefault('DATABASE_PROFILE', 'production')
+    app.config.setdefault('SQLITE_PRAGMAS', {})
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5.0)
+    app.config.setdefault('DATABASE_POOL_SIZE', 5)
+    app.config.setdefault('DATABASE_MAX_OVERFLOW', 10)
+    app.config.setdefault('DATABASE_POOL_TIMEOUT', 30)
+    app.config.setdefault('DATABASE_LOCK_RETRIES', 3)
+
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    options.setdefault('connect_args', {}).setdefault('timeout', app.config['SQLITE_BUSY_TIMEOUT'])
+    if not is_file_database(app.config['SQLALCHEMY_DATABASE_URI']):
+        return
+
+    options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+    options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', app.config['DATABASE_POOL_TIMEOUT'])
+
+
+'''Set the profile's pragmas on every connection the engine opens'''
+def init_app(app):
+    pragmas = dict(PROFILES[app.config['DATABASE_PROFILE']], **app.config['SQLITE_PRAGMAS'])
+    pragmas['busy_timeout'] = int(app.config['SQLITE_BUSY_TIMEOUT'] * 1000)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    with app.app_context():
+        event.listen(db.engine, 'connect', set_pragmas)
+
+
+############################################################################################################################
+'''
+--------------------------------  LOCK RETRIES  --------------------------------
+'''
+############################################################################################################################
+
+
+def is_lock_error(error):
+    message = str(error.orig).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+'''
+Retry a view when SQLite reports the database locked, rolling back first. A read transaction that
+has to upgrade to a write while another worker is writing fails at once instead of waiting for the
+busy timeout, so short writes such as cart updates are simply run again after a small backoff.
+'''
+def retry_on_lock(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        retries = current_app.config['DATABASE_LOCK_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return view(*args, **kwargs)
+            except OperationalError as error:
+                db.session.rollback()
+                if attempt == retries or not is_lock_error(error):
+                    raise
+                current_app.logger.warning('Database locked in %s, retrying (%d/%d)', view.__name__, attempt + 1, retries)
+                time.sleep(0.05 * 2 ** attempt + random.uniform(0, 0.05))
+    return wrapper
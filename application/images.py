@@ -0,0 +1,550 @@
+import hashlib
+import os
+import re
+import shutil
+import time
+import click
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, func, or_, and_, exists, update
+from sqlalchemy.orm import aliased
+from . import db
+from .models import ImageJob, Product, Category
+from .metrics import IMAGE_PROCESSING
+
+
+# Shown for a product/category until its thumbnail job has finished
+PLACEHOLDER_PICTURE = 'deafault.png'
+THUMBNAIL_SIZE = (350, 350)
+
+# Widths of the responsive variants made for every upload, each in WebP and in the upload's own format:
+# admin icon, grid card, product detail, and detail at 2x for high-DPI screens
+VARIANT_WIDTHS = (120, 250, 360, 720)
+
+# Rendered width of each kind of picture slot (see style.css), used for the srcset sizes attribute
+PICTURE_SIZES = {'icon': 120, 'small': 180, 'grid': 250, 'detail': 360}
+
+# Pictures are named after a hash of the upload, so a file never changes once written and browsers may
+# cache it for good. Uploads from before content addressing have random names of the same shape.
+IMMUTABLE_PICTURE = re.compile(r'[0-9a-f]{32}(-\d+)?\.[a-z]+')
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Owner type -> (model, picture column, variants column, cache namespaces to bump when the picture changes)
+OWNERS = {
+    'product': (Product, 'product_picture', 'product_picture_variants', ()),
+    'category': (Category, 'category_picture', 'category_picture_variants', ('categories',)),
+}
+
+_executor = None
+
+
+############################################################################################################################
+'''
+--------------------------------  PATHS  --------------------------------
+'''
+############################################################################################################################
+
+
+def images_dir(app=None):
+    app = app or current_app
+    return os.path.join(app.root_path, 'static', 'images')
+
+
+def uploads_dir(app=None):
+    app = app or current_app
+    path = os.path.join(app.instance_path, 'uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+############################################################################################################################
+'''
+--------------------------------  QUEUEING  --------------------------------
+
+An upload is written to instance/uploads untouched and an ImageJob row is added in the same
+transaction as the product/category change. Jobs are handed to the worker pool only once that
+transaction commits; a rollback drops them.
+
+Files are named after the hash of their content, so uploading the same photo again (or for another
+product) reuses the files already made. A discarded picture is only removed after the commit, by
+a background worker, and only when no product, category or unfinished job refers to it any more.
+An upload is removed once its job is done, unless another job still needs the same file; uploads
+of failed jobs are kept for a retry until a later upload for the same owner is done.
+'''
+############################################################################################################################
+
+
+'''Store an upload and queue its thumbnail for owner (a Product or Category), returning the placeholder picture'''
+def queue_picture(form_picture, pic_filename, owner):
+    owner_type = 'product' if isinstance(owner, Product) else 'category'
+    db.session.flush()
+
+    _, f_ext = os.path.splitext(pic_filename)
+    name = content_hash(form_picture.stream) + f_ext.lower()
+    original_path = os.path.join(uploads_dir(), name)
+    if not os.path.exists(original_path):
+        form_picture.save(original_path)
+
+    job = ImageJob(owner_type=owner_type, owner_id=owner.id, original=name, picture=name, status='pending')
+    db.session.add(job)
+    db.session.flush()
+
+    db.session.info.setdefault('image_jobs', []).append(job.id)
+    return PLACEHOLDER_PICTURE
+
+
+'''First 32 hex digits of the SHA-256 of a file, read in chunks and rewound for saving'''
+def content_hash(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()[:32]
+
+
+'''Remove a picture when the current transaction commits, if nothing refers to it by then'''
+def discard_picture(picture):
+    if picture != PLACEHOLDER_PICTURE:
+        db.session.info.setdefault('discarded_pictures', set()).add(picture)
+
+
+'''Number of products, categories and unfinished image jobs using a picture'''
+def picture_references(connection, picture):
+    counts = [
+        select(func.count()).where(Product.product_picture == picture),
+        select(func.count()).where(Category.category_picture == picture),
+        select(func.count()).where(ImageJob.picture == picture, or_(ImageJob.status == 'pending', ImageJob.status == 'processing')),
+    ]
+    return sum(connection.execute(count).scalar() for count in counts)
+
+
+'''Remove the files of pictures nothing refers to any more'''
+def release_pictures(pictures, directory):
+    with db.engine.connect() as connection:
+        unused = [picture for picture in pictures if not picture_references(connection, picture)]
+
+    for picture in unused:
+        remove_picture_files(picture, directory)
+
+
+'''Condition on ImageJob rows that may still read their upload: unfinished jobs, and failed jobs that can be retried'''
+def needs_original():
+    return or_(ImageJob.status == 'pending', ImageJob.status == 'processing',
+               and_(ImageJob.status == 'failed', ~superseded_job()))
+
+
+'''Remove the uploads no image job needs any more'''
+def release_originals(originals, directory):
+    with db.engine.connect() as connection:
+        unused = [original for original in originals
+                  if not connection.execute(select(func.count()).where(ImageJob.original == original, needs_original())).scalar()]
+
+    for original in unused:
+        try:
+            os.remove(os.path.join(directory, original))
+        except FileNotFoundError:
+            pass
+
+
+def _submit_committed_jobs(session):
+    app = current_app._get_current_object()
+
+    pictures = session.info.pop('discarded_pictures', None)
+    if pictures:
+        submit_release(app, pictures)
+
+    job_ids = session.info.pop('image_jobs', None)
+    if job_ids:
+        for job_id in job_ids:
+            submit_job(app, job_id)
+
+
+def _drop_rolled_back_jobs(session):
+    session.info.pop('image_jobs', None)
+    session.info.pop('discarded_pictures', None)
+
+
+'''Run a function on the worker pool, or inline when IMAGE_WORKERS is 0'''
+def run_in_background(app, function, *args):
+    global _executor
+
+    if not app.config['IMAGE_WORKERS']:
+        function(app, *args)
+        return
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config['IMAGE_WORKERS'], thread_name_prefix='image-worker')
+    _executor.submit(function, app, *args)
+
+
+'''Process an image job on the worker pool'''
+def submit_job(app, job_id):
+    run_in_background(app, process_job, job_id)
+
+
+############################################################################################################################
+'''
+--------------------------------  WORKER  --------------------------------
+'''
+############################################################################################################################
+
+
+'''Resize an upload to the catalog thumbnail size (SVGs are vector, so they are copied as they are)'''
+def make_thumbnail(original_path, picture_path):
+    if original_path.lower().endswith('.svg'):
+        shutil.copyfile(original_path, picture_path)
+        return
+
+    from PIL import Image
+    with Image.open(original_path) as i:
+        i.thumbnail(THUMBNAIL_SIZE)
+        i.save(picture_path)
+
+
+'''File name of one responsive variant of a picture, e.g. ab12-250.webp'''
+def variant_name(picture, width, webp=False):
+    stem, ext = os.path.splitext(picture)
+    return '%s-%d%s' % (stem, width, '.webp' if webp else ext)
+
+
+'''
+Write every variant width of an upload next to its picture, in WebP and in the upload's own format.
+Returns the widths made as stored on the owner (e.g. "120,250,360,720"), or None for SVGs, which
+scale without variants.
+'''
+def make_variants(original_path, picture, directory):
+    if original_path.lower().endswith('.svg'):
+        return None
+
+    from PIL import Image
+    names = [variant_name(picture, width, webp) for width in VARIANT_WIDTHS for webp in (True, False)]
+    if all(os.path.exists(os.path.join(directory, name)) for name in names):
+        # An identical upload was processed before
+        return ','.join(str(width) for width in VARIANT_WIDTHS)
+
+    with Image.open(original_path) as original:
+        original.load()
+        for width in VARIANT_WIDTHS:
+            i = original.copy()
+            i.thumbnail((width, width))
+            i.save(os.path.join(directory, variant_name(picture, width, webp=True)), 'WEBP', quality=80)
+
+            if i.mode not in ('RGB', 'L') and picture.lower().endswith(('.jpg', '.jpeg')):
+                i = i.convert('RGB')
+            i.save(os.path.join(directory, variant_name(picture, width)), optimize=True)
+
+    return ','.join(str(width) for width in VARIANT_WIDTHS)
+
+
+def process_job(app, job_id):
+    with app.app_context():
+        try:
+            _process_job(app, job_id)
+        except Exception as error:
+            db.session.rollback()
+            app.logger.exception('Image job %s crashed: %s', job_id, error)
+        finally:
+            db.session.remove()
+
+
+'''
+Condition on ImageJob rows that a later upload for the same owner wins over. A later job that has
+failed does not count, so the owner still gets the newest picture that could be made.
+'''
+def superseded_job():
+    later = aliased(ImageJob)
+    return exists().where(later.owner_type == ImageJob.owner_type, later.owner_id == ImageJob.owner_id,
+                          later.id > ImageJob.id, later.status != 'failed')
+
+
+def _process_job(app, job_id):
+    from .cache import catalog_changed
+
+    # Claim the job, so a job re-queued by another worker is only processed once
+    claimed = ImageJob.query.filter_by(id=job_id, status='pending').update({'status': 'processing'})
+    db.session.commit()
+    if not claimed:
+        return
+
+    job = db.session.get(ImageJob, job_id)
+    picture_path = os.path.join(images_dir(app), job.picture)
+
+    started = time.perf_counter()
+    try:
+        original_path = os.path.join(uploads_dir(app), job.original)
+        if not os.path.exists(picture_path):
+            make_thumbnail(original_path, picture_path)
+        variants = make_variants(original_path, job.picture, images_dir(app))
+    except Exception as error:
+        IMAGE_PROCESSING.observe(time.perf_counter() - started, status='failed')
+        job.status = 'failed'
+        job.error = str(error)[:255]
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        app.logger.warning('Image job %s failed: %s', job_id, error)
+        return
+
+    IMAGE_PROCESSING.observe(time.perf_counter() - started, status='done')
+    model, column, variants_column, namespaces = OWNERS[job.owner_type]
+
+    # A later upload for the same owner wins, even if it finishes first
+    superseded = db.session.query(ImageJob.id).filter(ImageJob.id == job.id, superseded_job()).first()
+    updated = 0 if superseded else model.query.filter_by(id=job.owner_id).update({column: job.picture, variants_column: variants})
+
+    job.status = 'done'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    if updated:
+        catalog_changed(*namespaces)
+    else:
+        # Superseded, or the owner was deleted while the job was queued
+        release_pictures([job.picture], images_dir(app))
+
+    # Neither this upload nor those of earlier failed jobs for the owner will be read again
+    failed = db.session.query(ImageJob.original).filter(ImageJob.owner_type == job.owner_type, ImageJob.owner_id == job.owner_id,
+                                                        ImageJob.id < job.id, ImageJob.status == 'failed')
+    release_originals({job.original, *(original for original, in failed)}, uploads_dir(app))
+
+
+'''Remove a picture and all of its variants'''
+def remove_picture_files(picture, directory):
+    stem, ext = os.path.splitext(picture)
+    paths = [os.path.join(directory, picture)]
+    for width in VARIANT_WIDTHS:
+        paths.append(os.path.join(directory, variant_name(picture, width)))
+        paths.append(os.path.join(directory, variant_name(picture, width, webp=True)))
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Never made (an SVG has no variants), or already removed by another worker
+            pass
+
+
+'''Send a picture with far-future, immutable caching and a strong ETag when its name is content-addressed'''
+def send_picture(filename):
+    from flask import send_from_directory
+    if not IMMUTABLE_PICTURE.fullmatch(filename):
+        return send_from_directory(images_dir(), filename)
+
+    response = send_from_directory(images_dir(), filename, etag=filename, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+
+'''
+Queue every job left pending by a previous run, and jobs stuck processing since a crash. Jobs a
+later upload has superseded in the meantime are finished without being applied. With no
+unfinished jobs (the usual case) this is a single read, so starting a worker writes nothing.
+'''
+def resume_jobs(app):
+    with app.app_context():
+        unfinished = db.session.query(ImageJob.id).filter(or_(ImageJob.status == 'pending', ImageJob.status == 'processing')).first()
+        if unfinished is None:
+            db.session.remove()
+            return
+
+        stale = datetime.utcnow() - timedelta(seconds=app.config['IMAGE_JOB_TIMEOUT'])
+        ImageJob.query.filter(ImageJob.status == 'processing', ImageJob.created_at < stale) \
+            .update({'status': 'pending'})
+
+        superseded = db.session.execute(
+            update(ImageJob)
+            .where(ImageJob.status == 'pending', superseded_job())
+            .values(status='done', finished_at=datetime.utcnow())
+            .returning(ImageJob.picture, ImageJob.original),
+            execution_options={'synchronize_session': False}).all()
+        db.session.commit()
+        release_pictures({picture for picture, _ in superseded}, images_dir(app))
+        release_originals({original for _, original in superseded}, uploads_dir(app))
+
+        job_ids = [job_id for job_id, in db.session.query(ImageJob.id).filter_by(status='pending')]
+        db.session.remove()
+
+    for job_id in job_ids:
+        submit_job(app, job_id)
+
+
+'''Put a failed job back in the queue'''
+def retry_job(job):
+    job.status = 'pending'
+    job.error = None
+    job.finished_at = None
+    db.session.info.setdefault('image_jobs', []).append(job.id)
+
+
+@click.command('generate-image-variants')
+@with_appcontext
+def generate_image_variants_command():
+    '''Make responsive variants for pictures uploaded before variants existed.'''
+    from .cache import catalog_changed
+
+    made = 0
+    for model, column, variants_column, namespaces in OWNERS.values():
+        owners = model.query.filter(getattr(model, variants_column).is_(None),
+                                    getattr(model, column) != PLACEHOLDER_PICTURE)
+        for owner in owners:
+            picture = getattr(owner, column)
+            picture_path = os.path.join(images_dir(), picture)
+            if not os.path.exists(picture_path):
+                continue
+            setattr(owner, variants_column, make_variants(picture_path, picture, images_dir()))
+            made += 1
+
+        db.session.commit()
+        catalog_changed(*namespaces)
+
+    click.echo('Made variants for %d pictures.' % made)
+
+
+############################################################################################################################
+'''
+--------------------------------  PICTURE SWEEPER  --------------------------------
+
+Files of discarded pictures are removed off the request, on the worker pool. Files can still be
+orphaned (a worker killed between commit and removal, files copied in by hand), so `flask
+sweep-pictures` reconciles static/images against the pictures in use and removes the
+content-addressed files nothing refers to, and removes the uploads in instance/uploads no image
+job needs. Files younger than PICTURE_SWEEP_GRACE seconds are left alone, they may belong to an
+upload still being saved.
+
+The sweep deletes from directories every app process shares but trusts whichever database the
+app is configured with, so it never runs by itself in the web workers. Run it from cron, or keep
+one process running `flask sweep-pictures --every 3600`. It refuses to remove anything when the
+database refers to none of the pictures on disk, as when the app points at a scratch database.
+'''
+############################################################################################################################
+
+
+def _release(app, pictures):
+    with app.app_context():
+        release_pictures(pictures, images_dir(app))
+
+
+'''Remove the files of discarded pictures in the background, once nothing refers to them'''
+def submit_release(app, pictures):
+    run_in_background(app, _release, sorted(pictures))
+
+
+'''Stems (names without extension) of every picture a product, category or unfinished job refers to'''
+def pictures_in_use():
+    queries = [
+        select(Product.product_picture).distinct(),
+        select(Category.category_picture).distinct(),
+        select(ImageJob.picture).where(or_(ImageJob.status == 'pending', ImageJob.status == 'processing')),
+    ]
+    return {os.path.splitext(picture)[0] for query in queries for picture, in db.session.execute(query)}
+
+
+'''Names of the uploads in instance/uploads an image job may still read'''
+def originals_in_use():
+    return {original for original, in db.session.execute(select(ImageJob.original).where(needs_original()).distinct())}
+
+
+'''Remove the files in a directory last modified before oldest that unused(name) accepts, returning how many'''
+def _remove_old_files(directory, oldest, unused):
+    removed = 0
+    for name in os.listdir(directory):
+        if not unused(name):
+            continue
+        try:
+            if os.path.getmtime(os.path.join(directory, name)) < oldest:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+'''
+Remove the picture files (and variants) in static/images nothing refers to, and the uploads in
+instance/uploads no image job needs, returning how many files were removed. Returns None without
+removing anything when the database refers to none of the pictures on disk.
+'''
+def sweep_orphaned_pictures(app):
+    with app.app_context():
+        pictures, uploads = images_dir(app), uploads_dir(app)
+        in_use, originals = pictures_in_use(), originals_in_use()
+        db.session.remove()
+
+    on_disk = {name[:32] for name in os.listdir(pictures) if IMMUTABLE_PICTURE.fullmatch(name)}
+    if on_disk and not on_disk & in_use:
+        app.logger.warning('Picture sweep refused: the database refers to none of the %d pictures in %s', len(on_disk), pictures)
+        return None
+
+    oldest = time.time() - app.config['PICTURE_SWEEP_GRACE']
+    # Only content-addressed pictures are ours to remove, the stem is the hash before any -width suffix
+    removed = _remove_old_files(pictures, oldest, lambda name: IMMUTABLE_PICTURE.fullmatch(name) and name[:32] not in in_use)
+    removed += _remove_old_files(uploads, oldest, lambda name: name not in originals)
+    return removed
+
+
+@click.command('sweep-pictures')
+@click.option('--every', type=click.IntRange(1), default=None, help='Keep sweeping every SECONDS instead of once.')
+@with_appcontext
+def sweep_pictures_command(every):
+    '''Remove picture files and uploads that no product, category or image job refers to.'''
+    app = current_app._get_current_object()
+    while True:
+        removed = sweep_orphaned_pictures(app)
+        if removed is None:
+            message = 'Refused: the database refers to none of the pictures on disk, is it the right one?'
+            if not every:
+                raise click.ClickException(message)
+            click.echo(message, err=True)
+        else:
+            click.echo('Removed %d orphaned files.' % removed)
+
+        if not every:
+            return
+        time.sleep(every)
+
+
+############################################################################################################################
+'''
+--------------------------------  TEMPLATE HELPERS  --------------------------------
+'''
+############################################################################################################################
+
+
+def _widths(variants):
+    return [int(width) for width in variants.split(',')] if variants else []
+
+
+'''URL of the variant that fits a picture slot, or of the picture itself when it has no variants'''
+def picture_src(picture, variants=None, size='grid'):
+    from flask import url_for
+    fitting = [width for width in _widths(variants) if width >= PICTURE_SIZES[size]]
+    if fitting:
+        picture = variant_name(picture, fitting[0])
+    return url_for('static', filename='images/' + picture)
+
+
+'''srcset attribute listing every variant of a picture with its width'''
+def picture_srcset(picture, variants=None, webp=False):
+    from flask import url_for
+    return ', '.join('%s %dw' % (url_for('static', filename='images/' + variant_name(picture, width, webp)), width)
+                     for width in _widths(variants))
+
+
+'''sizes attribute for a picture slot'''
+def picture_sizes(size='grid'):
+    return '%dpx' % PICTURE_SIZES[size]
+
+
+def init_app(app):
+    app.config.setdefault('IMAGE_WORKERS', 2)
+    app.config.setdefault('IMAGE_JOB_TIMEOUT', 600)
+    app.config.setdefault('PICTURE_SWEEP_GRACE', 3600)
+
+    app.add_template_global(picture_src)
+    app.add_template_global(picture_srcset)
+    app.add_template_global(picture_sizes)
+
+    if not event.contains(db.session, 'after_commit', _submit_committed_jobs):
+        event.listen(db.session, 'after_commit', _submit_committed_jobs)
+        event.listen(db.session, 'after_rollback', _drop_rolled_back_jobs)
@@ -0,0 +1,129 @@
+import re
+import time
+from collections import Counter
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from . import db
+
+
+############################################################################################################################
+'''
+--------------------------------  SQL INSTRUMENTATION  --------------------------------
+
+Opt-in with SQL_INSTRUMENTATION = True (FLASK_SQL_INSTRUMENTATION=true). Engine events time every
+statement and add it to the current request's QueryStats, and every response gets a Server-Timing
+header (db time and query count, plus the whole request) that browser dev tools show per request.
+
+Statements are grouped by their normalized SQL (literals and IN lists collapsed), so a statement
+run N_PLUS_ONE_THRESHOLD or more times in one request (a query in a loop over rows) is logged as a
+possible N+1, and any statement slower than SLOW_QUERY_MS is logged with the endpoint it ran for.
+'''
+############################################################################################################################
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+'''SQL with its literals replaced by ? and whitespace collapsed, so repeats of a statement compare equal'''
+def normalize_sql(statement):
+    statement = _LITERALS.sub('?', statement)
+    statement = _IN_LISTS.sub('(?...)', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+
+class QueryStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    # Raw SQL is counted (ORM statements repeat verbatim, values are bound) and only normalized when reported
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    '''Normalized statements run at least threshold times, most repeated first'''
+    def repeated(self, threshold):
+        counts = Counter()
+        for statement, count in self.statements.items():
+            counts[normalize_sql(statement)] += count
+        return [(statement, count) for statement, count in counts.most_common() if count >= threshold]
+
+    def __repr__(self):
+        return '<QueryStats %r queries, %.1fms>' % (self.count, self.duration * 1000)
+
+
+'''Stats of the current request, None outside a request or when queries are not collected'''
+def current_stats():
+    return g.get('query_stats') if has_request_context() else None
+
+
+def _endpoint():
+    return request.endpoint if has_request_context() else 'background'
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    from flask import current_app
+
+    duration = time.perf_counter() - connection.info['query_started'].pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.add(statement, duration)
+
+    if current_app.config['SQL_INSTRUMENTATION'] and duration * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        current_app.logger.warning('Slow query (%.1fms) in %s: %s', duration * 1000, _endpoint(), normalize_sql(statement))
+
+
+def _start_request():
+    g.query_stats = QueryStats()
+
+
+def _report_request(response):
+    from flask import current_app
+
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+
+    total = (time.perf_counter() - stats.started) * 1000
+    response.headers.add('Server-Timing', 'db;dur=%.1f;desc="%d queries"' % (stats.duration * 1000, stats.count))
+    response.headers.add('Server-Timing', 'total;dur=%.1f' % total)
+
+    for statement, count in stats.repeated(current_app.config['N_PLUS_ONE_THRESHOLD']):
+        current_app.logger.warning('Possible N+1 in %s: %d x %s', request.endpoint, count, statement)
+
+    return response
+
+
+'''Time every statement into the current request's QueryStats (for the reports here and for metrics)'''
+def collect_queries(app):
+    if app.extensions.get('query_stats'):
+        return
+    app.extensions['query_stats'] = True
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(_start_request)
+
+
+def init_app(app):
+    app.config.setdefault('SQL_INSTRUMENTATION', False)
+    app.config.setdefault('SLOW_QUERY_MS', 100)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 5)
+
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+
+    collect_queries(app)
+    app.after_request(_report_request)
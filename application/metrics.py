@@ -0,0 +1,251 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+############################################################################################################################
+'''
+--------------------------------  METRICS  --------------------------------
+
+Counters and histograms in the Prometheus text format, served at /admin/metrics.
+
+Recording is lock-free: every thread writes only to its own shard of each metric, and a scrape adds
+the shards up. A thread takes the metric's lock once, the first time it records to it, to register
+its shard. Shards of threads that have exited are folded into a base total (whenever a new thread
+registers, and on every scrape) and dropped, so counts never go backwards and a server starting a
+thread per request does not pile up shards.
+'''
+############################################################################################################################
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        # (thread, shard) of every live thread that has recorded, and the folded shards of exited ones
+        self._shards = []
+        self._base = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold_exited()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    # Called with the lock held. An exited thread can no longer write to its shard.
+    def _fold_exited(self):
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._base, shard)
+        self._shards = live
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    '''Values per label key added up over the base and every live shard'''
+    def _totals(self):
+        totals = {}
+        with self._lock:
+            self._fold_exited()
+            self._merge(totals, self._base)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            self._merge(totals, shard.copy())
+        return totals
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, totals, shard):
+        for key, value in shard.items():
+            totals[key] = totals.get(key, 0) + value
+
+    def totals(self):
+        return self._totals()
+
+    def _samples(self):
+        return ['%s%s %s' % (self.name, self._label_text(key), _number(value)) for key, value in sorted(self.totals().items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One count per bucket plus +Inf, then the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _merge(self, totals, shard):
+        for key, counts in shard.items():
+            total = totals.setdefault(key, [0] * len(counts))
+            for index, count in enumerate(list(counts)):
+                total[index] += count
+
+    def _samples(self):
+        lines = []
+        for key, counts in sorted(self._totals().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, self._label_text(key, [('le', _number(bound))]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, self._label_text(key), _number(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, self._label_text(key), cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    # The last value set wins, so gauges keep one dict instead of per-thread shards
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self._values = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return ['%s%s %s' % (self.name, self._label_text(key), _number(value)) for key, value in sorted(values.items())]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return value if isinstance(value, str) else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+'''The whole registry in the Prometheus text exposition format'''
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter('quickgrocer_http_requests_total', 'HTTP requests by endpoint, method and status.', ('endpoint', 'method', 'status'))
+REQUEST_LATENCY = Histogram('quickgrocer_http_request_duration_seconds', 'Time to produce a response.', ('endpoint',))
+RESPONSE_SIZE = Histogram('quickgrocer_http_response_size_bytes', 'Size of response bodies (streamed ones excluded).', ('endpoint',), SIZE_BUCKETS)
+DB_TIME = Histogram('quickgrocer_db_time_seconds', 'Time spent in SQL per request.', ('endpoint',))
+DB_QUERIES = Counter('quickgrocer_db_queries_total', 'SQL statements run by requests.', ('endpoint',))
+IMAGE_PROCESSING = Histogram('quickgrocer_image_processing_seconds', 'Time to make the thumbnail and variants of an upload.', ('status',))
+BCRYPT_TIME = Histogram('quickgrocer_bcrypt_seconds', 'Time spent hashing or checking passwords.', ('operation',))
+CACHE_REQUESTS = Counter('quickgrocer_cache_requests_total', 'Cache lookups by namespace and result (hit or miss).', ('namespace', 'result'))
+STARTUP_TIME = Gauge('quickgrocer_startup_seconds', 'Time the app took to start, per startup phase.', ('phase',))
+
+
+############################################################################################################################
+'''
+--------------------------------  REQUEST HOOKS  --------------------------------
+'''
+############################################################################################################################
+
+
+def _start_request():
+    from flask import g
+    g.metrics_started = time.perf_counter()
+
+
+def _finish_request(response):
+    from flask import g, request
+
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+
+    # Unrouted requests (404s for unknown paths) share one label, so bad URLs cannot add series
+    endpoint = request.endpoint or 'unmatched'
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+
+    if not response.is_streamed and response.content_length is not None:
+        RESPONSE_SIZE.observe(response.content_length, endpoint=endpoint)
+
+    stats = g.get('query_stats')
+    if stats is not None:
+        DB_TIME.observe(stats.duration, endpoint=endpoint)
+        DB_QUERIES.inc(stats.count, endpoint=endpoint)
+
+    return response
+
+
+'''True when the request carries the METRICS_TOKEN bearer token, for scrapers that cannot log in'''
+def scraper_authorized():
+    from flask import current_app, request
+
+    token = current_app.config['METRICS_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+
+
+def init_app(app):
+    from . import instrumentation
+
+    app.config.setdefault('METRICS', True)
+    app.config.setdefault('METRICS_TOKEN', None)
+
+    if not app.config['METRICS']:
+        return
+
+    instrumentation.collect_queries(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,131 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from . import db
+
+
+############################################################################################################################
+'''
+--------------------------------  SCHEMA MIGRATIONS  --------------------------------
+
+db.create_all() only creates missing tables, so every later change to an existing table is a
+numbered migration here. The number of the last one applied is kept in the database file itself
+(PRAGMA user_version) and pending ones run in order at startup, each in its own transaction.
+
+A new database is created from the models (which declare the same columns and indexes) and then
+runs the migrations too, so every step must be safe to run on a schema that already has it.
+
+At startup a database already at LATEST_VERSION skips db.create_all() altogether, so a new model
+needs a migration too, one that creates its table.
+'''
+############################################################################################################################
+
+
+def _columns(connection, table):
+    return [row[1] for row in connection.execute(text('PRAGMA table_info(%s)' % table))]
+
+
+def _add_column(connection, table, column, sql_type):
+    if column not in _columns(connection, table):
+        connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, sql_type)))
+
+
+def add_picture_variants(connection):
+    _add_column(connection, 'product', 'product_picture_variants', 'VARCHAR(40)')
+    _add_column(connection, 'category', 'category_picture_variants', 'VARCHAR(40)')
+
+
+def add_cart_indexes(connection):
+    # Merge duplicate lines of the same product into the oldest one, so (user_id, prod_id) can be unique
+    connection.execute(text('''
+        UPDATE cart SET product_quantity = (
+            SELECT SUM(other.product_quantity) FROM cart AS other
+            WHERE other.user_id = cart.user_id AND other.prod_id = cart.prod_id)
+        WHERE id IN (SELECT MIN(id) FROM cart GROUP BY user_id, prod_id HAVING COUNT(*) > 1)'''))
+    connection.execute(text('''
+        DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, prod_id)'''))
+
+    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_cart_user_product ON cart (user_id, prod_id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_cart_prod_id ON cart (prod_id)'))
+
+
+def add_product_indexes(connection):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_product_category_rate ON product (category_id, rate_per_unit)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_product_manufacture_date ON product (manufacture_date)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_product_picture ON product (product_picture)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_image_job_owner ON image_job (owner_type, owner_id)'))
+
+
+# Tables the JSON API serves, every write to them bumps the catalog version
+CATALOG_TABLES = ('product', 'category', 'unit')
+
+
+def add_catalog_version(connection):
+    # One row, bumped by triggers inside the writing transaction, so every worker and process sees the same version
+    connection.execute(text('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            modified INTEGER NOT NULL)'''))
+    connection.execute(text("INSERT OR IGNORE INTO catalog_version VALUES (1, 1, CAST(strftime('%s', 'now') AS INTEGER))"))
+
+    for table in CATALOG_TABLES:
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            connection.execute(text('''
+                CREATE TRIGGER IF NOT EXISTS catalog_version_{table}_{name} AFTER {operation} ON {table} BEGIN
+                    UPDATE catalog_version SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+                END'''.format(table=table, name=operation.lower(), operation=operation)))
+
+
+def add_search_tables(connection):
+    from .search import create_search_tables
+    create_search_tables(connection)
+
+
+# (version, description, function), in order. Never edit or renumber one that has shipped, add a new one.
+MIGRATIONS = [
+    (1, 'responsive picture variant columns', add_picture_variants),
+    (2, 'unique cart line per user and product, cart product index', add_cart_indexes),
+    (3, 'product filter, picture and image job indexes', add_product_indexes),
+    (4, 'catalog version row kept by triggers, for API validators', add_catalog_version),
+    (5, 'full-text and trigram search tables, facet counts', add_search_tables),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(connection):
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+'''Apply every migration newer than the database's user_version, returning the ones applied'''
+def migrate(app):
+    applied = []
+    with app.app_context():
+        for version, description, upgrade in MIGRATIONS:
+            with db.engine.begin() as connection:
+                if schema_version(connection) >= version:
+                    continue
+
+                upgrade(connection)
+                connection.execute(text('PRAGMA user_version = %d' % version))
+
+            applied.append((version, description))
+            app.logger.info('Applied migration %d: %s', version, description)
+
+    return applied
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    '''Apply pending schema migrations.'''
+    from flask import current_app
+    with db.engine.connect() as connection:
+        click.echo('Schema version %d, latest %d.' % (schema_version(connection), LATEST_VERSION))
+
+    applied = migrate(current_app)
+    for version, description in applied:
+        click.echo('Applied migration %d: %s' % (version, description))
+    if not applied:
+        click.echo('Nothing to migrate.')
@@ -1,5 +1,7 @@
 from flask_login import UserMixin
 from flask_bcrypt import Bcrypt
+from datetime import datetime
+from sqlalchemy.orm import joinedload
 from . import db
 
 bcrypt = Bcrypt()
@@ -43,6 +45,12 @@ class Cart(db.Model):
     prod_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     product_quantity = db.Column(db.Integer, nullable=False)
 
+    # One line per product in a user's cart; also serves lookups by user_id alone
+    __table_args__ = (
+        db.Index('ix_cart_user_product', 'user_id', 'prod_id', unique=True),
+        db.Index('ix_cart_prod_id', 'prod_id'),
+    )
+
 
     # Functions
     def __repr__(self):
@@ -53,6 +61,7 @@ class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     product_name = db.Column(db.String(80), unique=True, nullable=False)
     product_picture = db.Column(db.String(160), nullable=False, default='default.png')
+    product_picture_variants = db.Column(db.String(40), nullable=True)
     total_quantity = db.Column(db.Integer, unique=False, nullable=False)
     rate_per_unit = db.Column(db.Integer, unique=False, nullable=False)
     manufacture_date = db.Column(db.Date, unique=False, nullable=False)
@@ -64,6 +73,13 @@ class Product(db.Model):
     # One to many relationship with Cart
     cart = db.relationship('Cart', backref='product', lazy=True)
 
+    # Search filters (category, max price, earliest manufacture date) and picture reference counts
+    __table_args__ = (
+        db.Index('ix_product_category_rate', 'category_id', 'rate_per_unit'),
+        db.Index('ix_product_manufacture_date', 'manufacture_date'),
+        db.Index('ix_product_picture', 'product_picture'),
+    )
+
 
     #   Functions
     def __repr__(self):
@@ -74,6 +90,7 @@ class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     category_name = db.Column(db.String(80), unique=True, nullable=False)
     category_picture = db.Column(db.String(80), nullable=False, default='default.png')
+    category_picture_variants = db.Column(db.String(40), nullable=True)
     products = db.relationship('Product', backref='category', lazy=True)
 
 
@@ -119,6 +136,46 @@ class Unit(db.Model):
         return '<Unit %r>' % self.unit_name
 
 
+class ImageJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Product or category whose picture this job produces
+    owner_type = db.Column(db.String(20), nullable=False)
+    owner_id = db.Column(db.Integer, nullable=False)
+
+    # Upload as received (in instance/uploads) and the thumbnail it becomes (in static/images)
+    original = db.Column(db.String(160), nullable=False)
+    picture = db.Column(db.String(160), nullable=False)
+
+    # pending -> processing -> done / failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_image_job_owner', 'owner_type', 'owner_id'),
+    )
+
+
+    # Functions
+    def __repr__(self):
+        return '<ImageJob %r %r>' % (self.id, self.status)
+
+
+
+
+        
+
+
+
+''' Eager-loading options, so listing pages issue a constant number of queries however many rows they render '''
 
+# Product -> Unit / Category (many-to-one, joined into the product SELECT)
+def product_details():
+    return (joinedload(Product.unit), joinedload(Product.category))
 
-        
\ No newline at end of file
+# Cart -> Product -> Unit / Category
+def cart_details():
+    product = joinedload(Cart.product)
+    return (product, product.joinedload(Product.unit), product.joinedload(Product.category))
@@ -0,0 +1,116 @@
+import base64
+import binascii
+import json
+from flask import current_app, request, url_for
+from sqlalchemy import tuple_
+
+
+############################################################################################################################
+'''
+--------------------------------  KEYSET (CURSOR) PAGINATION  --------------------------------
+'''
+############################################################################################################################
+
+
+'''Encode the sort key of a row as an opaque, url-safe cursor'''
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+'''Decode a cursor back into its sort key, None if it is missing or was tampered with'''
+def decode_cursor(cursor, length):
+    if not cursor:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+        return None
+
+    return values
+
+
+'''Page size from ?per_page=, defaulting to PAGE_SIZE and capped at MAX_PAGE_SIZE'''
+def page_size():
+    per_page = request.args.get('per_page', type=int) or current_app.config['PAGE_SIZE']
+    return max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+
+
+class Page:
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, link_args=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.link_args = link_args
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<Page %r items>' % len(self.items)
+
+    ''' Links to the neighbouring pages keep the current route, view args and filters (or only link_args when given) '''
+    def _url(self, **cursor):
+        current = request.args if self.link_args is None else self.link_args
+        args = {key: value for key, value in current.items() if key not in ('after', 'before')}
+        args.update(cursor)
+        return url_for(request.endpoint, **request.view_args, **args)
+
+    @property
+    def next_url(self):
+        return self._url(after=self.next_cursor) if self.next_cursor else None
+
+    @property
+    def prev_url(self):
+        return self._url(before=self.prev_cursor) if self.prev_cursor else None
+
+
+'''
+Paginate a query on a unique, ascending sort key (e.g. [Product.id] or [rank, Product.id]).
+
+Instead of OFFSET, each page starts strictly after (or before) the sort key of the row at the
+edge of the previous page, so every page is an index range scan no matter how deep it is.
+Cursors are read from ?after= / ?before= on the current request. Page links carry every query arg
+of the request, or only link_args for a page rendered into a cache shared by other requests.
+'''
+def paginate(query, keys, per_page=None, link_args=None):
+    per_page = per_page or page_size()
+    after = decode_cursor(request.args.get('after'), len(keys))
+    before = decode_cursor(request.args.get('before'), len(keys)) if after is None else None
+
+    key = tuple_(*keys)
+    query = query.add_columns(*keys).order_by(None)
+
+    if before is not None:
+        rows = query.filter(key < tuple_(*before)).order_by(*[k.desc() for k in keys]).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+    else:
+        if after is not None:
+            query = query.filter(key > tuple_(*after))
+        rows = query.order_by(*keys).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+
+    items = [row[0] for row in rows]
+    if not rows:
+        return Page(items, per_page, link_args=link_args)
+
+    first = encode_cursor(rows[0][1:])
+    last = encode_cursor(rows[-1][1:])
+
+    if before is not None:
+        return Page(items, per_page, next_cursor=last, prev_cursor=first if has_more else None, link_args=link_args)
+    return Page(items, per_page, next_cursor=last if has_more else None, prev_cursor=first if after is not None else None,
+                link_args=link_args)
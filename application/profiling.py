@@ -0,0 +1,166 @@
+import cProfile
+import os
+import random
+import re
+import time
+from datetime import datetime
+import click
+from flask import current_app, request, g
+from flask.cli import with_appcontext
+from flask_login import current_user
+
+
+############################################################################################################################
+'''
+--------------------------------  REQUEST PROFILING  --------------------------------
+
+A logged in admin can profile any page by adding ?profile=1 to its URL (or sending X-Profile: 1).
+The request then runs under cProfile and the result is saved as a .pstats file, listed at
+/admin/profiles for download. pstats files open in snakeviz, or turn into flame graphs with
+flameprof / gprof2dot.
+
+With PROFILE_SAMPLE_RATE = N, one request in N (from anyone) is profiled the same way. Each kind
+keeps at most PROFILE_MAX_FILES files, the oldest are deleted.
+'''
+############################################################################################################################
+
+
+PROFILE_NAME = re.compile(r'(requested|sampled)-\d{8}-\d{6}-\d+-[\w.]+\.pstats')
+
+
+def profiles_dir(app=None):
+    app = app or current_app
+    path = os.path.join(app.instance_path, 'profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _requested():
+    if request.args.get('profile') != '1' and request.headers.get('X-Profile') != '1':
+        return False
+    return current_user.is_authenticated and current_user.is_admin()
+
+
+def _sampled():
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    return bool(rate) and random.randrange(rate) == 0
+
+
+def _start_request():
+    if request.endpoint in (None, 'static', 'views.picture'):
+        return
+
+    kind = 'requested' if _requested() else 'sampled' if _sampled() else None
+    if kind is None:
+        return
+
+    g.profile_kind = kind
+    g.profile_started = time.perf_counter()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def _finish_request(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+
+    profiler.disable()
+    kind = g.pop('profile_kind')
+    duration = time.perf_counter() - g.pop('profile_started')
+
+    name = '%s-%s-%d-%s.pstats' % (kind, datetime.now().strftime('%Y%m%d-%H%M%S'), int(duration * 1000), request.endpoint)
+    profiler.dump_stats(os.path.join(profiles_dir(), name))
+    prune_profiles(kind)
+
+    if kind == 'requested':
+        from flask import url_for
+        response.headers['X-Profile'] = url_for('auth_admin.download_profile', name=name)
+    return response
+
+
+'''Delete the oldest profiles of a kind beyond PROFILE_MAX_FILES'''
+def prune_profiles(kind):
+    names = sorted(profile['name'] for profile in list_profiles() if profile['kind'] == kind)
+    for name in names[:-current_app.config['PROFILE_MAX_FILES']]:
+        try:
+            os.remove(os.path.join(profiles_dir(), name))
+        except OSError:
+            # Pruned by another worker
+            pass
+
+
+'''Saved profiles, newest first, as dicts with name, kind, time, duration (ms), endpoint and size'''
+def list_profiles():
+    profiles = []
+    for name in os.listdir(profiles_dir()):
+        if not PROFILE_NAME.fullmatch(name):
+            continue
+        kind, day, clock, duration, endpoint = name[:-len('.pstats')].split('-', 4)
+        profiles.append({
+            'name': name,
+            'kind': kind,
+            'time': datetime.strptime(day + clock, '%Y%m%d%H%M%S'),
+            'duration': int(duration),
+            'endpoint': endpoint,
+            'size': os.path.getsize(os.path.join(profiles_dir(), name)),
+        })
+    return sorted(profiles, key=lambda profile: profile['name'][profile['name'].index('-'):], reverse=True)
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0)
+    app.config.setdefault('PROFILE_MAX_FILES', 50)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+############################################################################################################################
+'''
+--------------------------------  STARTUP TIMING  --------------------------------
+
+create_app times each phase of its startup. The breakdown is logged (INFO), exported as the
+quickgrocer_startup_seconds gauge and printed by `flask startup-report`, so a slow cold start on
+a new worker can be traced to the phase responsible.
+'''
+############################################################################################################################
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = []
+
+    '''Close the phase that ran since the previous mark'''
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def __str__(self):
+        return ', '.join('%s %.1fms' % (phase, seconds * 1000) for phase, seconds in self.phases)
+
+
+def report_startup(app, timer):
+    from .metrics import STARTUP_TIME
+
+    app.extensions['startup_timings'] = timer
+    for phase, seconds in timer.phases:
+        STARTUP_TIME.set(seconds, phase=phase)
+    app.logger.info('Started in %.0fms: %s', timer.total * 1000, timer)
+
+
+@click.command('startup-report')
+@with_appcontext
+def startup_report_command():
+    '''Show how long each phase of starting the app took.'''
+    timer = current_app.extensions['startup_timings']
+    for phase, seconds in timer.phases:
+        click.echo('%-22s %8.1fms' % (phase, seconds * 1000))
+    click.echo('%-22s %8.1fms' % ('total', timer.total * 1000))
@@ -0,0 +1,507 @@
+import functools
+import json
+import re
+import sqlite3
+from collections import Counter
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text, table, column, literal_column, false, case, bindparam
+from . import db
+from .models import Product, Category
+
+
+############################################################################################################################
+'''
+--------------------------------  FULL-TEXT SEARCH INDEX  --------------------------------
+'''
+############################################################################################################################
+
+
+# FTS5 tables over product/category names. They are external-content tables (the names live only in
+# product/category) and SQLite triggers keep them in sync with every insert, rename and delete.
+product_search = table('product_search', column('rowid'), column('rank'))
+category_search = table('category_search', column('rowid'), column('rank'))
+
+SEARCH_SCHEMA = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        product_name, content='product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_search(rowid, product_name) VALUES (new.id, new.product_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_search(product_search, rowid, product_name) VALUES ('delete', old.id, old.product_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_search_au AFTER UPDATE OF product_name ON product BEGIN
+        INSERT INTO product_search(product_search, rowid, product_name) VALUES ('delete', old.id, old.product_name);
+        INSERT INTO product_search(rowid, product_name) VALUES (new.id, new.product_name);
+    END''',
+
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS category_search USING fts5(
+        category_name, content='category', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')''',
+    '''CREATE TRIGGER IF NOT EXISTS category_search_ai AFTER INSERT ON category BEGIN
+        INSERT INTO category_search(rowid, category_name) VALUES (new.id, new.category_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS category_search_ad AFTER DELETE ON category BEGIN
+        INSERT INTO category_search(category_search, rowid, category_name) VALUES ('delete', old.id, old.category_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS category_search_au AFTER UPDATE OF category_name ON category BEGIN
+        INSERT INTO category_search(category_search, rowid, category_name) VALUES ('delete', old.id, old.category_name);
+        INSERT INTO category_search(rowid, category_name) VALUES (new.id, new.category_name);
+    END''',
+]
+
+
+_SCHEMA_OBJECT = re.compile(r'IF NOT EXISTS (\w+)')
+
+
+'''Statements of a schema whose table or trigger is not in the database yet'''
+def missing_statements(connection, schema):
+    existing = {name for name, in connection.execute(text("SELECT name FROM sqlite_master"))}
+    return [statement for statement in schema if _SCHEMA_OBJECT.search(statement).group(1) not in existing]
+
+
+def _has_table(connection, name):
+    return connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': name}).first() is not None
+
+
+'''Create the search tables and triggers if they are missing, populating them on first creation'''
+def create_search_index(connection):
+    exists = _has_table(connection, 'product_search')
+    for statement in missing_statements(connection, SEARCH_SCHEMA):
+        connection.execute(text(statement))
+    if not exists:
+        rebuild_search_index(connection)
+
+
+# Trigram tables for typo-tolerant search, kept in sync by triggers the same way (needs SQLite 3.34+)
+TRIGRAM_SCHEMA = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS product_trigram USING fts5(
+        product_name, content='product', content_rowid='id', tokenize='trigram')''',
+    '''CREATE TRIGGER IF NOT EXISTS product_trigram_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_trigram(rowid, product_name) VALUES (new.id, new.product_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_trigram_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_trigram(product_trigram, rowid, product_name) VALUES ('delete', old.id, old.product_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS product_trigram_au AFTER UPDATE OF product_name ON product BEGIN
+        INSERT INTO product_trigram(product_trigram, rowid, product_name) VALUES ('delete', old.id, old.product_name);
+        INSERT INTO product_trigram(rowid, product_name) VALUES (new.id, new.product_name);
+    END''',
+
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS category_trigram USING fts5(
+        category_name, content='category', content_rowid='id', tokenize='trigram')''',
+    '''CREATE TRIGGER IF NOT EXISTS category_trigram_ai AFTER INSERT ON category BEGIN
+        INSERT INTO category_trigram(rowid, category_name) VALUES (new.id, new.category_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS category_trigram_ad AFTER DELETE ON category BEGIN
+        INSERT INTO category_trigram(category_trigram, rowid, category_name) VALUES ('delete', old.id, old.category_name);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS category_trigram_au AFTER UPDATE OF category_name ON category BEGIN
+        INSERT INTO category_trigram(category_trigram, rowid, category_name) VALUES ('delete', old.id, old.category_name);
+        INSERT INTO category_trigram(rowid, category_name) VALUES (new.id, new.category_name);
+    END''',
+]
+
+
+'''Create the trigram tables and triggers if they are missing, populating them on first creation'''
+def create_trigram_index(connection):
+    exists = _has_table(connection, 'product_trigram')
+    for statement in missing_statements(connection, TRIGRAM_SCHEMA):
+        connection.execute(text(statement))
+    if not exists:
+        rebuild_trigram_index(connection)
+
+
+'''
+Create every missing search table, trigger and facet count (schema migration 5). The full-text and
+trigram indexes are skipped when this SQLite has no FTS5 or no trigram tokenizer.
+'''
+def create_search_tables(connection):
+    create_facet_counts(connection)
+    if sqlite_has_fts5():
+        create_search_index(connection)
+    if sqlite_has_fts5('trigram'):
+        create_trigram_index(connection)
+
+
+'''Whether the sqlite3 library has FTS5 (with the given tokenizer), probed once per process on an in-memory database'''
+@functools.cache
+def sqlite_has_fts5(tokenize='unicode61'):
+    probe = sqlite3.connect(':memory:')
+    try:
+        probe.execute("CREATE VIRTUAL TABLE probe USING fts5(name, tokenize='%s')" % tokenize)
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        probe.close()
+
+
+'''
+Turn full-text and fuzzy search on where the SQLite library supports them, without touching the
+database: the tables themselves are created by migration 5 (or flask rebuild-search-index)
+'''
+def configure_search(app):
+    app.config['FULL_TEXT_SEARCH'] = sqlite_has_fts5()
+    if not app.config['FULL_TEXT_SEARCH']:
+        app.logger.warning('Full-text search disabled, falling back to LIKE scans: SQLite has no FTS5')
+
+    app.config['FUZZY_SEARCH'] = sqlite_has_fts5('trigram')
+    if not app.config['FUZZY_SEARCH']:
+        app.logger.warning('Fuzzy search disabled, typo-tolerant searches run as normal ones: SQLite has no trigram tokenizer')
+
+
+'''Repopulate both search tables from the product and category tables'''
+def rebuild_search_index(connection):
+    connection.execute(text("INSERT INTO product_search(product_search) VALUES ('rebuild')"))
+    connection.execute(text("INSERT INTO category_search(category_search) VALUES ('rebuild')"))
+
+
+'''Repopulate both trigram tables from the product and category tables'''
+def rebuild_trigram_index(connection):
+    connection.execute(text("INSERT INTO product_trigram(product_trigram) VALUES ('rebuild')"))
+    connection.execute(text("INSERT INTO category_trigram(category_trigram) VALUES ('rebuild')"))
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    '''Create any missing search tables, then rebuild the full-text and trigram indexes and the facet counts.'''
+    connection = db.session.connection()
+    create_search_tables(connection)
+    if current_app.config.get('FULL_TEXT_SEARCH'):
+        rebuild_search_index(connection)
+    if current_app.config.get('FUZZY_SEARCH'):
+        rebuild_trigram_index(connection)
+    rebuild_facet_counts(connection)
+    db.session.commit()
+    click.echo('Search indexes and facet counts rebuilt.')
+
+
+############################################################################################################################
+'''
+--------------------------------  FACET COUNTS  --------------------------------
+
+product_facet holds how many products each sidebar filter value covers: per category, per price
+bucket and per manufacture month. Triggers on product add and subtract one per insert, edit and
+delete, so the counts stay exact and reading them never needs a GROUP BY over products.
+'''
+############################################################################################################################
+
+
+# Upper bounds of the price buckets, a product falls in the first one its rate fits under
+PRICE_BUCKETS = (10, 25, 50, 100, 250, 500, 1000)
+
+# Manufacture months offered in the date filter, newest first
+FACET_MONTHS = 12
+
+
+# (facet, SQL of its value) for the product row named row ('new', 'old' or 'product')
+def _facet_values(row):
+    price = "CASE %s ELSE 'more' END" % ' '.join(
+        "WHEN %s.rate_per_unit <= %d THEN '%d'" % (row, bound, bound) for bound in PRICE_BUCKETS)
+    return [
+        ('category', "CAST(%s.category_id AS TEXT)" % row),
+        ('price', price),
+        ('month', "substr(%s.manufacture_date, 1, 7)" % row),
+    ]
+
+
+def _add_facets(row):
+    return '\n'.join(
+        "INSERT INTO product_facet(facet, value, products) VALUES ('%s', %s, 1) "
+        "ON CONFLICT(facet, value) DO UPDATE SET products = products + 1;" % (facet, value)
+        for facet, value in _facet_values(row))
+
+
+def _remove_facets(row):
+    return '\n'.join(
+        "UPDATE product_facet SET products = products - 1 WHERE facet = '%s' AND value = %s;" % (facet, value)
+        for facet, value in _facet_values(row)) + "\nDELETE FROM product_facet WHERE products <= 0;"
+
+
+FACET_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS product_facet (
+        facet VARCHAR(20) NOT NULL, value VARCHAR(20) NOT NULL, products INTEGER NOT NULL,
+        PRIMARY KEY (facet, value)) WITHOUT ROWID''',
+    '''CREATE TRIGGER IF NOT EXISTS product_facet_ai AFTER INSERT ON product BEGIN
+        %s
+    END''' % _add_facets('new'),
+    '''CREATE TRIGGER IF NOT EXISTS product_facet_ad AFTER DELETE ON product BEGIN
+        %s
+    END''' % _remove_facets('old'),
+    '''CREATE TRIGGER IF NOT EXISTS product_facet_au AFTER UPDATE OF category_id, rate_per_unit, manufacture_date ON product BEGIN
+        %s
+        %s
+    END''' % (_remove_facets('old'), _add_facets('new')),
+]
+
+
+'''Create the facet table and triggers if they are missing, counting the products on first creation'''
+def create_facet_counts(connection):
+    exists = _has_table(connection, 'product_facet')
+    for statement in missing_statements(connection, FACET_SCHEMA):
+        connection.execute(text(statement))
+    if not exists:
+        rebuild_facet_counts(connection)
+
+
+'''Recount product_facet from the product table'''
+def rebuild_facet_counts(connection):
+    connection.execute(text("DELETE FROM product_facet"))
+    for facet, value in _facet_values('product'):
+        connection.execute(text(
+            "INSERT INTO product_facet(facet, value, products) "
+            "SELECT '%s', %s, count(*) FROM product GROUP BY 2" % (facet, value)))
+
+
+def _load_facets():
+    counts = {'category': {}, 'price': {}, 'month': {}}
+    for facet, value, products in db.session.execute(text("SELECT facet, value, products FROM product_facet")):
+        counts[facet][value] = products
+
+    # The filters are "at most this price" and "made since", so an option counts its bucket and all the ones before it
+    price, total = [], 0
+    for bound in PRICE_BUCKETS:
+        total += counts['price'].get(str(bound), 0)
+        price.append([bound, total])
+
+    month, total = [], 0
+    for value in sorted(counts['month'], reverse=True):
+        total += counts['month'][value]
+        month.append([value, total])
+
+    return {'category': counts['category'], 'price': price, 'month': month[:FACET_MONTHS]}
+
+
+'''
+Counts shown next to the sidebar filters, cached per catalog version:
+{'category': {'<id>': n}, 'price': [[bound, n at or under it]], 'month': [['YYYY-MM', n made since]]}
+'''
+def facet_counts():
+    from .cache import cache
+    return cache.remember('catalog', 'facets', _load_facets)
+
+
+############################################################################################################################
+'''
+--------------------------------  QUERIES  --------------------------------
+'''
+############################################################################################################################
+
+
+'''Turn free text into an FTS5 expression where every word is a quoted prefix, e.g. "tom"* "ket"*'''
+def match_expression(query):
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+'''Filter a Product query down to names matching the search text, best matches first'''
+def search_products(products, query):
+    if not current_app.config.get('FULL_TEXT_SEARCH'):
+        return products.filter(Product.product_name.contains(query))
+
+    expression = match_expression(query)
+    if not expression:
+        return products.filter(false())
+
+    return products.join(product_search, product_search.c.rowid == Product.id) \
+        .filter(literal_column('product_search').op('MATCH')(expression)) \
+        .order_by(product_search.c.rank)
+
+
+'''Filter a Category query down to names matching the search text, best matches first'''
+def search_categories(categories, query):
+    if not current_app.config.get('FULL_TEXT_SEARCH'):
+        return categories.filter(Category.category_name.contains(query))
+
+    expression = match_expression(query)
+    if not expression:
+        return categories.filter(false())
+
+    return categories.join(category_search, category_search.c.rowid == Category.id) \
+        .filter(literal_column('category_search').op('MATCH')(expression)) \
+        .order_by(category_search.c.rank)
+
+
+'''Apply the sidebar filters (max price, earliest manufacture date, category) to a Product query'''
+def filter_products(products, price=None, date_filter=None, category_id=None):
+    if price:
+        products = products.filter(Product.rate_per_unit <= float(price))
+
+    if date_filter:
+        products = products.filter(Product.manufacture_date >= date_filter)
+
+    if category_id:
+        products = products.filter(Product.category_id == category_id)
+
+    return products
+
+
+'''Product query of the search page (text match plus sidebar filters) and the sort key to paginate it on'''
+def find_products(products, query=None, price=None, date_filter=None, category_id=None, fuzzy=False):
+    sort_keys = product_sort_keys(query)
+    if query and fuzzy and current_app.config.get('FUZZY_SEARCH'):
+        products, sort_keys = fuzzy_search_products(products, query)
+    elif query:
+        products = search_products(products, query)
+    products = filter_products(products, price=price, date_filter=date_filter, category_id=category_id)
+    return products, sort_keys
+
+
+'''Sort key for paginating product search results, relevance first when the FTS index is used'''
+def product_sort_keys(query):
+    if query and current_app.config.get('FULL_TEXT_SEARCH') and match_expression(query):
+        return [product_search.c.rank, Product.id]
+    return [Product.id]
+
+
+############################################################################################################################
+'''
+--------------------------------  FUZZY SEARCH  --------------------------------
+
+With fuzzy=1 a search tolerates typos ("tomatoe", "brocoli"). Each trigram of the query words is
+looked up in the trigram index on its own, reading at most FUZZY_POSTINGS rows of it in rowid order
+(no ranking, so FTS5 stops there). A common trigram such as "tom" costs the same however many names
+contain it, and the rare trigrams, the ones that pick out a misspelt name, are read in full. The
+FUZZY_CANDIDATES names found under the most trigrams are then ranked by trigram similarity (Jaccard,
+per query word against the best matching word of the name) and the ones below FUZZY_MIN_SIMILARITY
+are dropped.
+'''
+############################################################################################################################
+
+
+'''Trigrams of a word padded like pg_trgm, so word starts and ends weigh in'''
+def trigrams(word):
+    padded = '  %s ' % word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+'''How similar a name is to the query words, from 0 to 1'''
+def similarity(words, name):
+    name_trigrams = [trigrams(word) for word in re.findall(r'\w+', name.lower())]
+    if not words or not name_trigrams:
+        return 0.0
+
+    total = 0.0
+    for word in words:
+        word_trigrams = trigrams(word)
+        total += max(len(word_trigrams & other) / len(word_trigrams | other) for other in name_trigrams)
+    return total / len(words)
+
+
+'''Trigrams of the words as the trigram tokenizer indexes them (unpadded), e.g. "tom", "oma"'''
+def query_trigrams(words):
+    return sorted({word[i:i + 3] for word in words for i in range(len(word) - 2)})
+
+
+'''Ids of the FUZZY_CANDIDATES rows of a trigram table found under the most of the trigrams'''
+def fuzzy_candidates(table_name, grams):
+    postings = text("SELECT rowid FROM %s WHERE %s MATCH :gram LIMIT :limit" % (table_name, table_name))
+    shared = Counter()
+    for gram in grams:
+        shared.update(id for id, in db.session.execute(postings, {'gram': '"%s"' % gram, 'limit': current_app.config['FUZZY_POSTINGS']}))
+    return [id for id, _ in sorted(shared.items(), key=lambda item: (-item[1], item[0]))[:current_app.config['FUZZY_CANDIDATES']]]
+
+
+'''(id, similarity) of the names in a trigram table most similar to the query, best first'''
+def fuzzy_matches(table_name, column_name, query):
+    words = re.findall(r'\w+', query.lower())
+    ids = fuzzy_candidates(table_name, query_trigrams(words))
+    if not ids:
+        return []
+
+    rows = db.session.execute(
+        text("SELECT rowid, %s FROM %s WHERE rowid IN :ids" % (column_name, table_name)).bindparams(bindparam('ids', expanding=True)),
+        {'ids': ids})
+
+    minimum = current_app.config['FUZZY_MIN_SIMILARITY']
+    scored = [(id, similarity(words, name)) for id, name in rows]
+    return sorted([match for match in scored if match[1] >= minimum], key=lambda match: (-match[1], match[0]))
+
+
+# Sort key putting ids in the given order, usable as a keyset pagination key
+def _position(column, ids):
+    return case({id: position for position, id in enumerate(ids)}, value=column)
+
+
+'''Filter a Product query down to names similar to the search text and give its sort keys, most similar first'''
+def fuzzy_search_products(products, query):
+    ids = [id for id, _ in fuzzy_matches('product_trigram', 'product_name', query)]
+    if not ids:
+        return products.filter(false()), [Product.id]
+    return products.filter(Product.id.in_(ids)), [_position(Product.id, ids), Product.id]
+
+
+'''Filter a Category query down to names similar to the search text, most similar first'''
+def fuzzy_search_categories(categories, query):
+    if not current_app.config.get('FUZZY_SEARCH'):
+        return search_categories(categories, query)
+
+    ids = [id for id, _ in fuzzy_matches('category_trigram', 'category_name', query)]
+    if not ids:
+        return categories.filter(false())
+    return categories.filter(Category.id.in_(ids)).order_by(_position(Category.id, ids))
+
+
+############################################################################################################################
+'''
+--------------------------------  CACHED RESULTS  --------------------------------
+
+A search page is cached as the ids it found plus its pagination cursors, keyed on the normalized
+query and filters, so "Tomato  Ketchup" and "tomato ketchup" share an entry. Entries live in the
+'catalog' namespace, so any admin write invalidates them, and expire after SEARCH_CACHE_TTL
+seconds. A hit costs one primary key lookup for the products; categories come from the cache.
+'''
+############################################################################################################################
+
+
+'''Search text as the index sees it: lowercase words for FTS5, the trimmed text for LIKE'''
+def normalize_query(query):
+    if not query:
+        return None
+    if current_app.config.get('FULL_TEXT_SEARCH'):
+        return ' '.join(re.findall(r'\w+', query.lower())) or None
+    return query.strip() or None
+
+
+def _search_key(query, price, date_filter, category_id, fuzzy):
+    from flask import request
+    from .pagination import page_size
+    return 'search:%s' % json.dumps([query, price, date_filter and date_filter.isoformat(), category_id, fuzzy,
+                                     page_size(), request.args.get('after'), request.args.get('before')])
+
+
+'''Matching categories and a Page of matching products, for the cursors of the current request'''
+def search_page(query=None, price=None, date_filter=None, category_id=None, fuzzy=False):
+    from .cache import cache, get_category
+    from .models import product_details
+    from .pagination import Page, page_size, paginate
+
+    query = normalize_query(query)
+    price = float(price) if price else None
+
+    def load():
+        products, sort_keys = find_products(Product.query.with_entities(Product.id), query,
+                                            price=price, date_filter=date_filter, category_id=category_id, fuzzy=fuzzy)
+        page = paginate(products, sort_keys)
+        categories = []
+        if query:
+            search = fuzzy_search_categories if fuzzy else search_categories
+            categories = [id for id, in search(Category.query.with_entities(Category.id), query)]
+        return {'products': page.items, 'next': page.next_cursor, 'prev': page.prev_cursor, 'categories': categories}
+
+    found = cache.remember('catalog', _search_key(query, price, date_filter, category_id, fuzzy), load,
+                           current_app.config['SEARCH_CACHE_TTL'])
+
+    products = {}
+    if found['products']:
+        products = {product.id: product for product in
+                    Product.query.options(*product_details()).filter(Product.id.in_(found['products']))}
+
+    page = Page([products[id] for id in found['products'] if id in products], page_size(), found['next'], found['prev'])
+    categories = [category for category in map(get_category, found['categories']) if category is not None]
+    return categories, page
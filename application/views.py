@@ -1,16 +1,29 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, abort
 from flask_login import current_user
-from .models import User, Category, Product
+from .models import User, Category, Product, product_details
 from . import db
+from .search import search_page
+from .pagination import paginate
+from .cache import get_categories, get_category, cached_fragment, fragment_args
+from .images import send_picture
 from datetime import datetime
 
 views = Blueprint("views", __name__)
 
 
+'''Search form with the category filter, rendered once per catalog version with no filter selected'''
+def search_form():
+    return cached_fragment('search_form', lambda: render_template("search_form.html", ctgrs=get_categories(), filters={}))
+
+
 #Home page
 @views.route("/")
 def home():
-    return render_template("home.html", user=current_user, ctgrs=Category.query.all(), products=Product.query.all())
+    def render_catalog():
+        page = paginate(Product.query.options(*product_details()), [Product.id], link_args=fragment_args())
+        return render_template("home_catalog.html", ctgrs=get_categories(), products=page.items, page=page)
+
+    return render_template("home.html", user=current_user, search_form=search_form(), catalog=cached_fragment('home', render_catalog))
 
 
 #To search for products
@@ -24,57 +37,52 @@ def search():
     if not price and not date_filter and not category_id and not query:
         return redirect(url_for('views.home'))
 
-    categories = None
-    ctgrs = Category.query.all()
-    products = Product.query
-
-    if query:
-        categories = Category.query
-        categories = categories.filter(Category.category_name.contains(query))
-        categories = categories.all()
-
-        products = products.filter(Product.product_name.contains(query))
-
-
-    if price:
-        products = products.filter(Product.rate_per_unit <= float(price))
+    ctgrs = get_categories()
 
     if date_filter:
         date_filter = datetime.strptime(date_filter, '%Y-%m-%d').date()
-        products = products.filter(Product.manufacture_date >= date_filter)
 
-    if category_id:
-        products = products.filter(Product.category_id == category_id)
-        
-    products = products.all()
+    fuzzy = request.args.get('fuzzy') == '1'
+    categories, page = search_page(query, price=price, date_filter=date_filter, category_id=request.args.get('category_id', type=int), fuzzy=fuzzy)
 
-    return render_template("search_results.html", user=current_user, ctgrs=ctgrs, categories=categories, products=products, price=price, date_filter=date_filter, category_id=category_id, query=query)
+    return render_template("search_results.html", user=current_user, ctgrs=ctgrs, categories=categories, products=page.items, page=page, price=price, date_filter=date_filter, category_id=category_id, query=query, fuzzy=fuzzy)
 
 
 #To view products of a particular category
 @views.route("/category/<int:category_id>")
 def view_category(category_id):
-    category = Category.query.filter_by(id=category_id).first()
-    products = Product.query.filter_by(category_id=category.id).all()
-    return render_template("category.html", user=current_user, category=category, products=products)
+    category = get_category(category_id)
+    if category is None:
+        abort(404)
+
+    def render_catalog():
+        page = paginate(Product.query.options(*product_details()).filter_by(category_id=category_id), [Product.id], link_args=fragment_args())
+        return render_template("category_catalog.html", category=category, products=page.items, page=page)
+
+    return render_template("category.html", user=current_user, search_form=search_form(), catalog=cached_fragment('category', render_catalog))
 
 
 #To view a particular product
 @views.route("/product/<int:product_id>")
 def view_product(product_id):
-    product = Product.query.filter_by(id=product_id).first()
+    product = Product.query.options(*product_details()).filter_by(id=product_id).first()
     return render_template("product.html", user=current_user, product=product)
 
 
 #To view all categories
 @views.route("/categories")
 def categories():
-    return render_template("all_categories.html", user=current_user, ctgrs=Category.query.all())
+    return render_template("all_categories.html", user=current_user, ctgrs=get_categories())
 
 
 #To view all products
 @views.route("/products")
 def products():
-    return render_template("all_products.html", user=current_user, products=Product.query.all())
+    page = paginate(Product.query.options(*product_details()), [Product.id])
+    return render_template("all_products.html", user=current_user, products=page.items, page=page)
 
 
+#Catalog pictures, cached by browsers for good since their names change with their content
+@views.route("/static/images/<path:filename>")
+def picture(filename):
+    return send_picture(filename)